@@ -1,11 +1,20 @@
 #! /usr/bin/env python3
-import os, sys, re
+import os, sys, re, zlib
 from mod_python import apache, util
 from json import dumps
-import pyinotify
 import sqlite3
+from time import time
+
+# the action log store lives in roomd, one directory up
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import roomd
 
 ROOM_RGX = r'^[A-Z0-9]{5}$'
+ACTION_RGX = r'^[a-z]{2,10}$'
+
+LOG_LIMIT = 50
+LOG_MAX_LIMIT = 1000
+EXPORT_CHUNK = 65536
 
 class DBConnection:
     def __init__(self, room_db):
@@ -23,7 +32,11 @@ def getowners(room_db, room):
     if not re.match(ROOM_RGX, room):
         raise Exception("getowners: Room format incorrect: " + room)
     with DBConnection(room_db) as [conn, cur]:
-        allusers = list(cur.execute("SELECT owners FROM room{0}".format(room)))
+        try:
+            return [str(row[0]) for row in cur.execute("SELECT username FROM owners WHERE room == ? ORDER BY rowid", (room,))]
+        except sqlite3.OperationalError:
+            # room has not been converted to the normalized schema yet (see roomd.migrateroom)
+            allusers = list(cur.execute("SELECT owners FROM room{0}".format(room)))
         if len(allusers) == 0:
             return []
         allusers = allusers[0]
@@ -37,10 +50,57 @@ except KeyError:
     # so we are being invoked by mod_python, so we need different env vars
     private = os.environ['HOME'] + '/private/queup/'
 
-def getdblog(room):
-    with open(private + "room.log") as f:
-        data = [x.split(",") for x in f.read().split("\n") if room in x]
-    return data
+roomd.private = private
+
+def getdblog(room, limit=None, **filters):
+    return roomd.getlog(room, limit, **filters)
+
+# the before/after times and action/user lists (comma separated) that narrow
+# down log and fulllog; raises ValueError if any of them is malformed
+def getlogfilters(query):
+    filters = {}
+    for name in ['before', 'after']:
+        value = roomd.getfield(query, name)
+        if value != "":
+            filters[name] = float(value)
+    for name, field, rgx in [('actions', 'action', ACTION_RGX), ('users', 'user', roomd.USER_RGX.pattern)]:
+        value = roomd.getfield(query, field)
+        if value != "":
+            filters[name] = value.split(",")
+            if not all([re.match(rgx, x) for x in filters[name]]):
+                raise ValueError("bad " + field)
+    return filters
+
+# write the whole (filtered) log of a room as JSON or as room.log lines, in
+# chunks of about EXPORT_CHUNK bytes, gzipped if compress is set
+def streamlog(req, room, fmt, compress, filters):
+    encoder = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    chunk = []
+    size = 0
+    def flush(chunk, final=False):
+        data = "".join(chunk).encode("utf-8")
+        if encoder is not None:
+            data = encoder.compress(data) + (encoder.flush() if final else b"")
+        if len(data) > 0:
+            req.write(data)
+    if fmt == "json":
+        chunk.append("[")
+    first = True
+    for row in roomd.iterlog(room, **filters):
+        line = roomd.formatlogrow(row)
+        if fmt == "json":
+            line = ("" if first else ",") + dumps(line.split(","))
+        else:
+            line += "\n"
+        first = False
+        chunk.append(line)
+        size += len(line)
+        if size >= EXPORT_CHUNK:
+            flush(chunk)
+            chunk, size = [], 0
+    if fmt == "json":
+        chunk.append("]")
+    flush(chunk, True)
 
 def handler(req):
     # initialize some variables
@@ -48,18 +108,8 @@ def handler(req):
     query = util.FieldStorage(req)
     ip = req.useragent_ip
 
-    class EventHandler(pyinotify.ProcessEvent):
-        def process_IN_MODIFY(self, event):
-            try:
-                data = json.dumps(getdblog(room))
-                sys.stderr.write("writes out - " + data + "\r\n")
-                sys.stderr.flush()
-                req.write("data: %s\n\r" % data)
-            except:
-                pass
-
     # now check our variables
-    accepted_keys = ['sseupdate', 'log', 'fulllog']
+    accepted_keys = ['sseupdate', 'log', 'fulllog', 'clearlog', 'stats']
     querychecked = any([x in query for x in accepted_keys]) and 'room' in query
     room = query.get("room", "")
     
@@ -73,17 +123,31 @@ def handler(req):
         return apache.HTTP_FORBIDDEN
     
     # this section handles enabling any student to join a room
-    if querychecked and 'log' in query:
+    if querychecked and ('log' in query or 'fulllog' in query):
         room = query.get("room", "")
-        req.content_type = "application/json"
+        try:
+            filters = getlogfilters(query)
+            limit = int(roomd.getfield(query, 'limit', str(LOG_LIMIT)))
+        except ValueError:
+            return apache.HTTP_BAD_REQUEST
+        if 'log' in query:
+            # one page of the log, by default the newest LOG_LIMIT rows; pass
+            # the first row's time as before for the page before it
+            req.content_type = "application/json"
+            req.send_http_header()
+            req.write(dumps(getdblog(room, max(1, min(limit, LOG_MAX_LIMIT)), **filters)))
+            return apache.OK
+        fmt = roomd.getfield(query, 'format', 'json')
+        if fmt not in ['json', 'csv']:
+            return apache.HTTP_BAD_REQUEST
+        compress = roomd.getfield(query, 'gzip') == '1' or 'gzip' in req.headers_in.get('Accept-Encoding', '')
+        req.content_type = "application/json" if fmt == "json" else "text/csv"
+        req.headers_out['Content-Disposition'] = 'attachment; filename="actionlog_{0}.{1}"'.format(room, fmt)
+        req.headers_out['Vary'] = 'Accept-Encoding'
+        if compress:
+            req.headers_out['Content-Encoding'] = 'gzip'
         req.send_http_header()
-        req.write(dumps(getdblog(room)[-50:]))
-        return apache.OK
-    elif querychecked and 'fulllog' in query:
-        room = query.get("room", "")
-        req.content_type = "application/json"
-        req.send_http_header()
-        req.write(dumps(getdblog(room)))
+        streamlog(req, room, fmt, compress, filters)
         return apache.OK
     elif querychecked and 'sseupdate' in query:
         room = query.get("room", "")
@@ -91,25 +155,31 @@ def handler(req):
         req.content_type = "text/event-stream;charset=UTF-8"
         req.send_http_header()
         req.write("\n\r")
-        global wm
-        wm = pyinotify.WatchManager()
-        notifier = pyinotify.Notifier(wm, EventHandler(), timeout=30*1000)
-        wdd = wm.add_watch(private + 'rooms/' + room + '.db', pyinotify.IN_MODIFY, rec=True)
-        # start pyinotify
-        while True:
-            notifier.process_events()
-            while notifier.check_events():
-                # above line returns after 30 seconds or if queue is updated
-                notifier.read_events()
-                notifier.process_events()
-            try:
-                req.write("data: %s\n\r" % dumps(getdblog(room)[-50:]))
-            except:
-                wm.close()
-                try:
-                    sys.exit(0)
-                except:
-                    os._exit(0)
+        # all admins watching this room in this process share one hub, which
+        # tails the log; with delta=1 only the new rows are sent
+        hub = roomd.getloghub(room)
+        roomd.streamhub(req, hub, deltas=roomd.getfield(query, 'delta') == '1', lastid=req.headers_in.get('Last-Event-ID', None))
+        return apache.OK
+    elif querychecked and 'stats' in query:
+        # queue lengths, throughput and wait times since a time (by default
+        # over the last day), from the statistics kept as the log is written
+        room = query.get("room", "")
+        try:
+            since = float(roomd.getfield(query, 'since')) if roomd.getfield(query, 'since') != "" else None
+        except ValueError:
+            return apache.HTTP_BAD_REQUEST
+        req.content_type = "application/json"
+        req.send_http_header()
+        req.write(dumps(roomd.getstats(room, since), separators=(',', ':')))
+        return apache.OK
+    elif querychecked and 'clearlog' in query:
+        room = query.get("room", "")
+        path, cleared = roomd.clearlog(room)
+        roomd.lockAndWriteLog(",".join([str(time()), user, "rlogclr", room, str(cleared)]))
+        req.content_type = "text/plain"
+        req.send_http_header()
+        req.write("cleared")
+        return apache.OK
     # invalid request
     else:
         return apache.HTTP_BAD_REQUEST
@@ -22,7 +22,11 @@ def getowners(room_db, room):
     if not re.match(ROOM_RGX, room):
         raise Exception("getowners: Room format incorrect: " + room)
     with DBConnection(room_db) as [conn, cur]:
-        allusers = list(cur.execute("SELECT owners FROM room{0}".format(room)))
+        try:
+            return [str(row[0]) for row in cur.execute("SELECT username FROM owners WHERE room == ? ORDER BY rowid", (room,))]
+        except sqlite3.OperationalError:
+            # room has not been converted to the normalized schema yet (see roomd.migrateroom)
+            allusers = list(cur.execute("SELECT owners FROM room{0}".format(room)))
         if len(allusers) == 0:
             return []
         allusers = allusers[0]
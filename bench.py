@@ -0,0 +1,242 @@
+#! /usr/bin/env python3
+# load generator for roomd's request handler. it drives a mix of requests
+# against throwaway rooms in a temporary data directory, without Apache, and
+# reports latency percentiles, throughput, SQLite connections opened and bytes
+# read per request, and how quickly sseupdate subscribers see each change.
+#
+# usage: bench.py [--mix chk,add,mark,clear] [--requests N] [--threads N]
+#                 [--rooms N] [--users N] [--subscribers N] [--output FILE]
+import os
+import sys
+import shutil
+import sqlite3
+import argparse
+import tempfile
+import threading
+from time import time, sleep
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import roomd
+
+class Request:
+    # stands in for a mod_python request; the query is handed to dispatch
+    # directly instead of being parsed by util.FieldStorage
+    def __init__(self, user, query):
+        self.user = user
+        self.query = query
+        self.useragent_ip = "127.0.0.1"
+        self.headers_in = {}
+        self.headers_out = {}
+        self.content_type = None
+        self.out = []
+        self.errors = []
+    def send_http_header(self):
+        pass
+    def write(self, data):
+        self.out.append(data)
+    def log_error(self, message):
+        self.errors.append(message)
+
+class Subscriber(Request):
+    # an sseupdate client that notes when each event arrives, and hangs up
+    # once the benchmark is over
+    def __init__(self, user, query, done):
+        Request.__init__(self, user, query)
+        self.done = done
+        self.events = []
+    def write(self, data):
+        if self.done.is_set():
+            raise IOError("subscriber closed")
+        if not data.startswith(":"):
+            self.events.append(time())
+
+def call(user, **query):
+    req = Request(user, query)
+    start = time()
+    status = roomd.dispatch(req, lambda: query)
+    return time() - start, status, req
+
+# counts connections opened through sqlite3.connect, by the pool and hubs alike
+opens = [0]
+connect = sqlite3.connect
+def countingconnect(*args, **kwargs):
+    opens[0] += 1
+    return connect(*args, **kwargs)
+
+def readbytes():
+    # bytes this process has read through read() calls, where available
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("rchar:"):
+                    return int(line.split()[1])
+    except (IOError, OSError):
+        pass
+    return None
+
+def percentile(values, p):
+    if len(values) == 0:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+def owner(i):
+    return "own%d" % i
+
+def student(i):
+    return "stu%d" % i
+
+def roomcode(i):
+    return "BN%03d" % i
+
+class Workload:
+    def __init__(self, args):
+        self.args = args
+        self.lock = threading.Lock()
+        self.counter = 0
+        self.queued = {}        # room -> students currently in its queue
+        self.changes = []       # times of requests that changed a room
+    def setup(self):
+        for r in range(self.args.rooms):
+            t, status, req = call(owner(r), setup="1", action="add", room=roomcode(r))
+            if status != roomd.apache.OK:
+                raise Exception("setup: could not create room %s: %s" % (roomcode(r), req.errors))
+            self.queued[roomcode(r)] = []
+    def next(self):
+        with self.lock:
+            n = self.counter
+            self.counter += 1
+        return n
+    # one request of the given kind, as (kind, user, query)
+    def request(self, kind, n):
+        r = n % self.args.rooms
+        room = roomcode(r)
+        if kind == "chk":
+            return student(n % self.args.users), {"setup": "1", "action": "chk", "room": room}
+        if kind == "add":
+            # students join and leave in turn, so queues stay short
+            with self.lock:
+                queued = self.queued[room]
+                user = student(n % self.args.users)
+                if user in queued:
+                    queued.remove(user)
+                    return user, {"action": "del", "room": room, "queue": "default_queue"}
+                queued.append(user)
+            return user, {"action": "add", "room": room, "queue": "default_queue"}
+        if kind == "mark":
+            with self.lock:
+                queued = list(self.queued[room])
+            if len(queued) == 0:
+                return owner(r), {"setup": "1", "action": "chk", "room": room, "queue": "default_queue"}
+            return owner(r), {"setup": "1", "action": "mark", "room": room, "queue": "default_queue",
+                              "username": queued[n % len(queued)]}
+        if kind == "clear":
+            with self.lock:
+                self.queued[room] = []
+            return owner(r), {"setup": "1", "action": "clear", "room": room, "queue": "default_queue"}
+        raise Exception("request: unknown kind " + kind)
+    def worker(self, kinds, count, results):
+        for i in range(count):
+            n = self.next()
+            kind = kinds[n % len(kinds)]
+            user, query = self.request(kind, n)
+            t, status, req = call(user, **query)
+            if kind != "chk":
+                with self.lock:
+                    self.changes.append(time())
+            results.append((kind, t, status))
+
+def run(args):
+    private = tempfile.mkdtemp(prefix="queup-bench-")
+    os.makedirs(os.path.join(private, "rooms"))
+    open(os.path.join(private, "nodel_rooms"), "w").close()
+    roomd.private = os.path.join(private, "")
+    # the point is to measure the handler, not to be turned away by it
+    roomd.RATELIMIT_USER = (1e9, 1e9)
+    roomd.RATELIMIT_ROOM = (1e9, 1e9)
+    sqlite3.connect = countingconnect
+    lines = []
+    try:
+        work = Workload(args)
+        work.setup()
+        done = threading.Event()
+        subscribers = []
+        threads = []
+        for i in range(args.subscribers):
+            req = Subscriber("sub%d" % i, {"sseupdate": "1", "room": roomcode(i % args.rooms)}, done)
+            thread = threading.Thread(target=roomd.dispatch, args=(req, lambda query=req.query: query))
+            thread.daemon = True
+            thread.start()
+            subscribers.append(req)
+            threads.append(thread)
+        sleep(0.5 if args.subscribers > 0 else 0)
+        kinds = args.mix.split(",")
+        results = []
+        workers = [threading.Thread(target=work.worker, args=(kinds, args.requests // args.threads, results))
+                   for i in range(args.threads)]
+        opened, read = opens[0], readbytes()
+        start = time()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        elapsed = time() - start
+        opened, read = opens[0] - opened, (readbytes() - read) if read is not None else None
+        roomd.logwriter.flush()
+        sleep(roomd.HUB_COALESCE_MAX + roomd.HUB_POLL_INTERVAL)
+        done.set()
+        # every subscriber sees one more change (or a heartbeat) and leaves
+        for r in range(args.rooms):
+            call(owner(r), setup="1", action="setsub", room=roomcode(r), subtitle="done")
+        for thread in threads:
+            thread.join(roomd.SSE_HEARTBEAT + 1)
+
+        lines.append("requests: %d in %.2fs, %.1f/s with %d threads" % (len(results), elapsed, len(results) / elapsed, args.threads))
+        lines.append("rooms: %d, users: %d, subscribers: %d" % (args.rooms, args.users, args.subscribers))
+        lines.append("sqlite connections opened: %d (%.3f per request)" % (opened, float(opened) / max(len(results), 1)))
+        if read is not None:
+            lines.append("bytes read: %d (%.0f per request)" % (read, float(read) / max(len(results), 1)))
+        lines.append("%-8s %7s %9s %9s %9s %9s %7s" % ("kind", "count", "p50 ms", "p95 ms", "p99 ms", "max ms", "errors"))
+        for kind in sorted(set(kinds)) + ["all"]:
+            times = [t * 1000 for k, t, status in results if kind in (k, "all")]
+            errors = len([1 for k, t, status in results if kind in (k, "all") and status != roomd.apache.OK])
+            lines.append("%-8s %7d %9.2f %9.2f %9.2f %9.2f %7d" % (kind, len(times), percentile(times, 50), percentile(times, 95),
+                                                                   percentile(times, 99), max(times or [0]), errors))
+        if args.subscribers > 0:
+            # how long after each change the subscribers of its room heard of it
+            delays = []
+            for req in subscribers:
+                for event in req.events:
+                    before = [c for c in work.changes if c <= event]
+                    if len(before) > 0:
+                        delays.append((event - before[-1]) * 1000)
+            lines.append("sse events: %d, delay p50 %.2f ms, p95 %.2f ms, p99 %.2f ms" % (
+                len(delays), percentile(delays, 50), percentile(delays, 95), percentile(delays, 99)))
+    finally:
+        sqlite3.connect = connect
+        roomd.logwriter.flush()
+        for path in list(roomd.pool.idle.keys()):
+            roomd.pool.discard(path)
+        shutil.rmtree(private, ignore_errors=True)
+    return lines
+
+def main():
+    parser = argparse.ArgumentParser(description="QueUp request handler benchmark")
+    parser.add_argument("--mix", default="chk,chk,add,add,mark,chk,add,clear",
+                        help="comma separated request kinds, repeated in order: chk, add, mark, clear")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--rooms", type=int, default=4)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--subscribers", type=int, default=20)
+    parser.add_argument("--output", default=None, help="also write the report to this file (e.g. bench_output.txt)")
+    args = parser.parse_args()
+    report = "\n".join(run(args)) + "\n"
+    sys.stdout.write(report)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            f.write(report)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
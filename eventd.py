@@ -0,0 +1,226 @@
+#! /usr/bin/env python3
+# standalone server for the long-lived sseupdate streams of roomd.py and
+# admin/admin.py. under mod_python every open browser tab holds an Apache
+# worker for as long as it is open; this server holds each stream as an idle
+# socket in one asyncio loop instead, so the number of viewers is no longer
+# bounded by Apache's worker limit.
+#
+# run it next to Apache and proxy only the sseupdate requests to it, passing
+# the authenticated user along, e.g.:
+#
+#   RequestHeader set X-Remote-User "%{REMOTE_USER}s"
+#   RewriteEngine On
+#   RewriteCond %{QUERY_STRING} (^|&)sseupdate=
+#   RewriteRule ^(admin/admin|roomd)\.py$ http://127.0.0.1:8090/$1.py [P,L]
+#
+# usage: eventd.py [--host 127.0.0.1] [--port 8090] [--private DIR]
+import os
+import sys
+import asyncio
+import argparse
+from urllib.parse import urlsplit, parse_qs
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import roomd
+
+# a client that has this many bytes of events it has not read is dropped
+MAX_CLIENT_BUFFER = 1 << 20
+MAX_REQUEST_HEAD = 16384
+
+def encodeevent(eventid, data, isdelta=False):
+    return ("id: %s\n%sdata: %s\n\n" % (eventid, "event: delta\n" if isdelta else "", data)).encode("utf-8")
+
+class Channel:
+    # every connection to one stream (room or admin log) shares a channel,
+    # which listens to the roomd hub of that stream
+    def __init__(self, server, key, hub, until=None):
+        self.server = server
+        self.key = key
+        self.hub = hub
+        self.until = until
+        self.clients = set()
+        self.deltaclients = set()   # clients that asked for delta events
+        self.seq = None
+        self.lastid = None
+        self.payload = None
+        self.full = None
+    # the event that brings a client from lastid to the current state, or
+    # None if it is already there
+    def catchup(self, client, lastid):
+        if lastid == self.lastid:
+            return None
+        if client in self.deltaclients:
+            eventid, data, isdelta = self.hub.since(lastid)
+            if isdelta:
+                return encodeevent(eventid, data, True)
+        return self.full
+    async def start(self):
+        # the first render reads the database, so keep it off the event loop
+        loop = asyncio.get_event_loop()
+        listener = lambda seq, payload: loop.call_soon_threadsafe(self.publish, seq, payload)
+        self.listener = listener
+        await loop.run_in_executor(None, self.hub.subscribe, listener)
+        seq, payload = self.hub.wait(None, 0)
+        self.publish(seq, payload)
+    def stop(self):
+        self.hub.unsubscribe(self.listener)
+    def publish(self, seq, payload):
+        if self.seq is not None and seq <= self.seq:
+            return
+        self.seq = seq
+        previous = self.lastid
+        self.lastid, self.payload, isdelta = self.hub.since(None)
+        if self.lastid == previous:
+            return
+        self.full = encodeevent(self.lastid, self.payload)
+        delta = None
+        if previous is not None and len(self.deltaclients) > 0:
+            eventid, data, isdelta = self.hub.since(previous)
+            if isdelta and eventid == self.lastid:
+                delta = encodeevent(eventid, data, True)
+        for client in list(self.clients):
+            self.send(client, delta if delta is not None and client in self.deltaclients else self.full)
+            if self.until is not None and self.payload == self.until:
+                client.close()
+    def send(self, client, data):
+        if client.is_closing() or client.transport.get_write_buffer_size() > MAX_CLIENT_BUFFER:
+            client.close()
+            self.clients.discard(client)
+            self.deltaclients.discard(client)
+            return
+        client.write(data)
+
+class EventServer:
+    def __init__(self, private, userheader):
+        self.private = private
+        self.userheader = userheader.lower()
+        self.channels = {}
+        self.lock = asyncio.Lock()
+    async def channel(self, key, until=None):
+        async with self.lock:
+            channel = self.channels.get(key, None)
+            if channel is None:
+                # room events are identified by room version, log events by row id
+                if key[0] == "room":
+                    hub = roomd.getroomhub(key[1], roomd.roomdb(key[1]))
+                else:
+                    hub = roomd.getloghub(key[1])
+                channel = Channel(self, key, hub, until)
+                await channel.start()
+                self.channels[key] = channel
+            return channel
+    def release(self, channel, client):
+        channel.clients.discard(client)
+        channel.deltaclients.discard(client)
+        if len(channel.clients) == 0 and self.channels.get(channel.key, None) is channel:
+            del self.channels[channel.key]
+            channel.stop()
+    async def heartbeat(self):
+        while True:
+            await asyncio.sleep(roomd.SSE_HEARTBEAT)
+            for channel in list(self.channels.values()):
+                for client in list(channel.clients):
+                    channel.send(client, b": heartbeat\n\n")
+    async def handle(self, reader, writer):
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            writer.close()
+            return
+        lines = head.decode("latin-1").split("\r\n")
+        try:
+            method, target, version = lines[0].split(" ")
+        except ValueError:
+            return self.reply(writer, "400 Bad Request")
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+        url = urlsplit(target)
+        query = dict([(k, v[0]) for k, v in parse_qs(url.query).items()])
+        user = headers.get(self.userheader, "")
+        room = query.get("room", "")
+        if method != "GET" or "sseupdate" not in query:
+            return self.reply(writer, "400 Bad Request")
+        if user == "" or user == "(null)":
+            return self.reply(writer, "401 Unauthorized")
+        if not roomd.ROOM_RGX.match(room) or not os.path.exists(roomd.roomdb(room)):
+            return self.reply(writer, "404 Not Found")
+        path = roomd.roomdb(room)
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, roomd.ensureschema, path)
+        if url.path.endswith("admin/admin.py"):
+            owners = await loop.run_in_executor(None, roomd.getowners, room)
+            if user not in owners:
+                return self.reply(writer, "403 Forbidden")
+            channel = await self.channel(("log", room))
+        elif url.path.endswith("roomd.py"):
+            channel = await self.channel(("room", room), "{}")
+        else:
+            return self.reply(writer, "404 Not Found")
+        writer.write(("HTTP/1.1 200 OK\r\n"
+                      "Content-Type: text/event-stream;charset=UTF-8\r\n"
+                      "Cache-Control: no-cache\r\n"
+                      "X-Accel-Buffering: no\r\n"
+                      "Connection: close\r\n\r\n").encode("latin-1"))
+        channel.clients.add(writer)
+        if roomd.getfield(query, "delta") == "1":
+            channel.deltaclients.add(writer)
+        # a client resuming from the event it last saw needs nothing resent,
+        # or only what changed since if it takes deltas
+        event = channel.catchup(writer, headers.get("last-event-id", None))
+        if event is not None:
+            channel.send(writer, event)
+        if channel.until is not None and channel.payload == channel.until:
+            writer.close()
+        try:
+            # idle until the client hangs up; anything it sends is ignored
+            while not writer.is_closing():
+                if await reader.read(1024) == b"":
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            self.release(channel, writer)
+            writer.close()
+    def reply(self, writer, status):
+        writer.write(("HTTP/1.1 %s\r\nContent-Length: 0\r\nConnection: close\r\n\r\n" % status).encode("latin-1"))
+        writer.close()
+
+def raisefdlimit():
+    # each idle stream is one file descriptor
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+def main():
+    parser = argparse.ArgumentParser(description="QueUp server-sent event server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--private", default=os.environ.get("HOME", "") + "/private/queup/",
+                        help="QueUp data directory (default: $HOME/private/queup/)")
+    parser.add_argument("--user-header", default="X-Remote-User",
+                        help="request header carrying the authenticated user (default: X-Remote-User)")
+    args = parser.parse_args()
+    roomd.private = os.path.join(args.private, "")
+    raisefdlimit()
+    server = EventServer(roomd.private, args.user_header)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    listener = loop.run_until_complete(asyncio.start_server(server.handle, args.host, args.port,
+                                                            limit=MAX_REQUEST_HEAD, backlog=4096))
+    loop.create_task(server.heartbeat())
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
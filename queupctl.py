@@ -0,0 +1,194 @@
+#! /usr/bin/env python3
+# command line maintenance tool for the QueUp data directory.
+# usage: queupctl.py [--private DIR] <command> [options]
+import os
+import sys
+import sqlite3
+import argparse
+from time import time, strftime, localtime
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import roomd
+
+def migrate(args):
+    # convert every room database still using a table per queue
+    rooms = sorted([f for f in os.listdir(roomd.private + "rooms") if f.endswith(".db")])
+    for f in rooms:
+        try:
+            migrated = roomd.migrateroom(roomd.private + "rooms/" + f)
+            print("%s: %s" % (f, "migrated" if migrated else "up to date"))
+        except Exception as e:
+            print("%s: failed: %s" % (f, str(e)))
+
+def exportlog(args):
+    # write the action log in the old room.log format
+    if args.output == "-":
+        roomd.exportlog(sys.stdout, args.room)
+    else:
+        with open(args.output, "w") as f:
+            roomd.exportlog(f, args.room)
+
+def importlog(args):
+    # load an existing room.log into the action log store
+    with open(args.file or roomd.private + "room.log") as f:
+        print("imported %d lines" % roomd.importlog(f))
+    print("rebuilt queue statistics from %d log rows" % roomd.rebuildstats())
+
+def pruneratelimit(keep):
+    # drop rows of the old ratelimit.db older than keep seconds and give the
+    # space back; returns the number of rows dropped, or None without the file
+    path = roomd.private + "ratelimit.db"
+    if not os.path.exists(path):
+        return None
+    conn = sqlite3.connect(path, timeout=roomd.POOL_BUSY_TIMEOUT)
+    try:
+        conn.execute("CREATE TABLE IF NOT EXISTS ratelimit (username TEXT KEY, time REAL)")
+        pruned = conn.execute("DELETE FROM ratelimit WHERE time < ?", (time() - keep,)).rowcount
+        conn.commit()
+        conn.execute("VACUUM")
+        return pruned
+    finally:
+        conn.close()
+
+def prunerl(args):
+    # ratelimit.db is no longer written (see RateLimiter in roomd.py); drop
+    # its old rows, or the whole file, and give the space back
+    path = roomd.private + "ratelimit.db"
+    if not os.path.exists(path):
+        print("no ratelimit.db")
+        return
+    if args.remove:
+        for f in [path, path + "-wal", path + "-shm"]:
+            if os.path.exists(f):
+                os.remove(f)
+        print("removed ratelimit.db")
+        return
+    print("pruned %d rows" % pruneratelimit(args.keep))
+
+def stats(args):
+    # print a room's queue statistics, or recompute them all from the log
+    if args.rebuild:
+        print("rebuilt queue statistics from %d log rows" % roomd.rebuildstats())
+        return
+    if args.room is None:
+        print("stats: --room or --rebuild is required")
+        return
+    since = time() - args.hours * 3600
+    for queue, q in sorted(roomd.getstats(args.room, since).items()):
+        print("%s: %d waiting, %d arrivals, %d removals" % (queue, q["length"], q["arrivals"], q["removals"]))
+        for name in ["wait", "tomark"]:
+            print("  %-7s n=%d %s" % (name, q[name]["n"], "  ".join(["p%d %s" % (p, "-" if q[name]["p%d" % p] is None else "%.0fs" % q[name]["p%d" % p])
+                                                                   for p in roomd.STATS_PERCENTILES])))
+
+def catalog(args):
+    # list rooms from the room catalog, after rebuilding it if asked to
+    if args.rebuild:
+        print("cataloged %d rooms" % roomd.rebuildcatalog())
+        return
+    for code, created, lastactive, size, owners in roomd.listrooms(args.owner, args.idle):
+        print("%s  created %s  active %s  %8d bytes  %s" % (code, strftime("%Y-%m-%d %H:%M", localtime(created)),
+                                                          strftime("%Y-%m-%d %H:%M", localtime(lastactive)), size, ",".join(owners)))
+
+def maintain(args):
+    # meant to be run from cron, e.g. hourly:
+    #   0 * * * * queupctl.py maintain
+    # one run at a time; a second one gives up after roomd.LOCK_TIMEOUT
+    with roomd.Lock(roomd.private + "maintain"):
+        if not os.path.exists(roomd.private + roomd.CATALOG_DB):
+            print("cataloged %d rooms" % roomd.rebuildcatalog())
+        else:
+            # rooms from before the catalog, or removed behind its back
+            added, dropped = roomd.reconcilecatalog()
+            if added > 0 or dropped > 0:
+                print("cataloged %d rooms, dropped %d gone rooms" % (added, dropped))
+        # expire idle rooms, except the permanent ones in nodel_rooms
+        before = time() - args.idle * 3600
+        for code, created, lastactive, size, owners in roomd.listrooms(idle=args.idle * 3600):
+            if roomd.getroompermanency(code):
+                continue
+            if args.dry_run:
+                print("%s: would expire, idle since %s" % (code, strftime("%Y-%m-%d %H:%M", localtime(lastactive))))
+            elif roomd.expireroom(code, before):
+                roomd.lockAndWriteLog(",".join([str(time()), "queupctl", "rexpire", code]))
+                print("%s: expired, idle since %s" % (code, strftime("%Y-%m-%d %H:%M", localtime(lastactive))))
+        if args.dry_run:
+            return
+        # compact what is left
+        saved = 0
+        for code, created, lastactive, size, owners in roomd.listrooms():
+            # skip rooms removed since the listing
+            if not os.path.exists(roomd.roomdb(code)):
+                continue
+            try:
+                saved += roomd.compactdb(roomd.roomdb(code))
+                roomd.catalogroom(code, created, lastactive)
+            except Exception as e:
+                print("%s: compact failed: %s" % (code, str(e)))
+        print("compacted rooms, %d bytes saved" % saved)
+        # move old log rows to a compressed room.log file in archive/
+        if args.log_days > 0:
+            path, archived = roomd.archivelog(time() - args.log_days * 86400)
+            if archived == 0:
+                print("no log rows to archive")
+            else:
+                print("archived %d log rows to %s" % (archived, path))
+            roomd.prunestats(time() - args.log_days * 86400)
+        saved = roomd.compactdb(roomd.openlogdb()) + roomd.compactdb(roomd.opencatalog())
+        print("compacted log and catalog, %d bytes saved" % saved)
+        pruned = pruneratelimit(args.ratelimit_keep)
+        if pruned is not None:
+            print("pruned %d ratelimit.db rows" % pruned)
+        roomd.logwriter.flush()
+
+def main():
+    parser = argparse.ArgumentParser(description="QueUp maintenance tool")
+    parser.add_argument("--private", default=os.environ.get("HOME", "") + "/private/queup/",
+                        help="QueUp data directory (default: $HOME/private/queup/)")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("migrate", help="convert room databases to the normalized schema")
+    p = commands.add_parser("exportlog", help="write the action log as room.log lines")
+    p.add_argument("--room", default=None, help="only export this room")
+    p.add_argument("--output", default="-", help="output file (default: stdout)")
+    p = commands.add_parser("importlog", help="load a room.log file into the action log store")
+    p.add_argument("--file", default=None, help="room.log to import (default: room.log in the data directory)")
+    p = commands.add_parser("stats", help="show a room's queue statistics")
+    p.add_argument("--room", default=None)
+    p.add_argument("--hours", type=float, default=24, help="over the last HOURS hours (default: 24)")
+    p.add_argument("--rebuild", action="store_true", help="recompute the statistics of every room from the log")
+    p = commands.add_parser("catalog", help="list rooms from the room catalog")
+    p.add_argument("--rebuild", action="store_true", help="recreate the catalog from the room databases")
+    p.add_argument("--owner", default=None, help="only rooms owned by this user")
+    p.add_argument("--idle", type=float, default=None, help="only rooms not changed for IDLE seconds")
+    p = commands.add_parser("prunerl", help="prune and compact the old ratelimit.db")
+    p.add_argument("--keep", type=float, default=3600, help="keep rows from the last KEEP seconds (default: 3600)")
+    p.add_argument("--remove", action="store_true", help="delete ratelimit.db entirely")
+    p = commands.add_parser("maintain", help="expire idle rooms, compact databases and archive the log (for cron)")
+    p.add_argument("--idle", type=float, default=24, help="expire rooms not changed for IDLE hours (default: 24)")
+    p.add_argument("--log-days", type=float, default=90,
+                   help="archive log rows (and forget queue statistics) older than LOG_DAYS days, 0 to keep them all (default: 90)")
+    p.add_argument("--ratelimit-keep", type=float, default=3600,
+                   help="keep ratelimit.db rows from the last RATELIMIT_KEEP seconds (default: 3600)")
+    p.add_argument("--dry-run", action="store_true", help="only list the rooms that would be expired")
+    args = parser.parse_args()
+    roomd.private = os.path.join(args.private, "")
+    if args.command == "migrate":
+        migrate(args)
+    elif args.command == "exportlog":
+        exportlog(args)
+    elif args.command == "importlog":
+        importlog(args)
+    elif args.command == "stats":
+        stats(args)
+    elif args.command == "catalog":
+        catalog(args)
+    elif args.command == "prunerl":
+        prunerl(args)
+    elif args.command == "maintain":
+        maintain(args)
+    else:
+        parser.print_help()
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,387 +5,1716 @@ import re
 import sys
 import sqlite3
 import shutil
-from time import time, sleep
+import threading
+import atexit
+import struct
+import hashlib
+import gzip
+import errno
+from collections import OrderedDict
+from time import time, sleep, strftime
 try:
     from mod_python import apache, util
-    import pyinotify
 except:
-    pass
+    # outside of mod_python (wsgi.py, eventd.py, queupctl.py) the handler's
+    # return codes are plain HTTP statuses, with 0 meaning 200
+    class apache:
+        OK = 0
+        HTTP_NOT_MODIFIED = 304
+        HTTP_BAD_REQUEST = 400
+        HTTP_UNAUTHORIZED = 401
+        HTTP_NOT_FOUND = 404
+        HTTP_PRECONDITION_FAILED = 412
+        HTTP_LOCKED = 423
+        HTTP_INTERNAL_SERVER_ERROR = 500
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import mmap
+except ImportError:
+    mmap = None
+# faster JSON encoders, used for room snapshots and responses when installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
 
-# predefined here so handler will set their values
-room_db = ""
+# the data directory, set once per process: by handler from the environment
+# under mod_python, by wsgi.py, or by the command line tools
 private = ""
 
-def doexec(path):
-    exec(compile(open(path).read(), path, "exec"), globals())
+# every room lives in its own database
+def roomdb(room):
+    return private + "rooms/" + room + ".db"
+
+# counters and latency histograms, served in the Prometheus text format by
+# ?metrics=1 to the users listed in metrics_users (see readlistfile). they
+# are kept per process and only in memory: under Apache each request, and so
+# each scrape, reaches one of the children, which reports only what it served
+# itself (told apart by the pid label), and its numbers start over whenever
+# it is recycled. they show how requests are served, not totals for the site.
+METRICS_USERS = "metrics_users"
+METRICS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METRICS_HELP = {
+    "queup_requests_total": ("counter", "Requests served, by kind of request and status."),
+    "queup_request_seconds": ("histogram", "Time to serve a request, by kind of request (excluding sseupdate streams)."),
+    "queup_phase_seconds": ("histogram", "Time spent in each phase of serving a request."),
+    "queup_db_opens_total": ("counter", "SQLite connections opened."),
+    "queup_db_wait_seconds": ("histogram", "Time to get a pooled connection, begin a transaction, or commit."),
+    "queup_lock_wait_seconds": ("histogram", "Time spent waiting for file locks."),
+    "queup_sse_subscribers": ("gauge", "Open sseupdate streams served by this process, by kind of stream (room or log)."),
+    "queup_snapshot_cache_total": ("counter", "Room snapshots served from the encoded snapshot cache (hit) or read and encoded (miss)."),
+}
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}      # (name, labels) -> value
+        self.histograms = {}    # (name, labels) -> [count per bucket..., sum, count]
+    def count(self, name, labels=(), value=1):
+        with self.lock:
+            self.counters[(name, labels)] = self.counters.get((name, labels), 0) + value
+    def observe(self, name, value, labels=()):
+        with self.lock:
+            h = self.histograms.get((name, labels), None)
+            if h is None:
+                h = self.histograms[(name, labels)] = [0] * (len(METRICS_BUCKETS) + 2)
+            for i in range(len(METRICS_BUCKETS)):
+                if value <= METRICS_BUCKETS[i]:
+                    h[i] += 1
+            h[-2] += value
+            h[-1] += 1
+    def timer(self, name, labels=()):
+        return MetricTimer(self, name, labels)
+    def render(self, gauges=[]):
+        # gauges are (name, labels, value), sampled by the caller
+        def fmt(labels):
+            pairs = [(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in (("pid", os.getpid()),) + labels]
+            return "{" + ",".join(['%s="%s"' % pair for pair in pairs]) + "}"
+        samples = {}
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                samples.setdefault(name, []).append("%s%s %s" % (name, fmt(labels), repr(value)))
+            for (name, labels), h in sorted(self.histograms.items()):
+                lines = samples.setdefault(name, [])
+                for i in range(len(METRICS_BUCKETS)):
+                    lines.append("%s_bucket%s %d" % (name, fmt(labels + (("le", repr(METRICS_BUCKETS[i])),)), h[i]))
+                lines.append("%s_bucket%s %d" % (name, fmt(labels + (("le", "+Inf"),)), h[-1]))
+                lines.append("%s_sum%s %s" % (name, fmt(labels), repr(h[-2])))
+                lines.append("%s_count%s %d" % (name, fmt(labels), h[-1]))
+        for name, labels, value in gauges:
+            samples.setdefault(name, []).append("%s%s %s" % (name, fmt(labels), repr(value)))
+        out = []
+        for name in sorted(samples.keys()):
+            kind, text = METRICS_HELP.get(name, ("untyped", name))
+            out.append("# HELP %s %s" % (name, text))
+            out.append("# TYPE %s %s" % (name, kind))
+            out += samples[name]
+        return "\n".join(out) + "\n"
+
+class MetricTimer:
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+    def __enter__(self):
+        self.start = time()
+        return self
+    def __exit__(self, type, value, traceback):
+        self.metrics.observe(self.name, time() - self.start, self.labels)
+
+metrics = Metrics()
+
+# connections are kept open per process and shared between requests instead
+# of being opened and closed by every helper. idle connections are closed after
+# POOL_IDLE_TIMEOUT seconds, and at most POOL_MAX_IDLE are kept per database.
+POOL_MAX_IDLE = 4
+POOL_MAX_DATABASES = 64
+POOL_IDLE_TIMEOUT = 300
+POOL_STATEMENT_CACHE = 256
+POOL_BUSY_TIMEOUT = 10
+
+class PooledConnection(sqlite3.Connection):
+    pass
+
+class ConnectionPool:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = {}          # path -> list of [conn, inode, last used]
+        self.lastsweep = time()
+    def connect(self, path):
+        conn = sqlite3.connect(path, timeout=POOL_BUSY_TIMEOUT, check_same_thread=False,
+                               cached_statements=POOL_STATEMENT_CACHE, factory=PooledConnection)
+        metrics.count("queup_db_opens_total")
+        # WAL lets readers (chk, sseupdate) proceed while a writer commits
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        return conn
+    def inode(self, path):
+        try:
+            st = os.stat(path)
+            return (st.st_dev, st.st_ino)
+        except OSError:
+            return None
+    def acquire(self, path):
+        now = time()
+        inode = self.inode(path)
+        stale = []
+        conn = None
+        with self.lock:
+            if now - self.lastsweep > POOL_IDLE_TIMEOUT / 10.0:
+                stale = self.sweep(now)
+            entries = self.idle.get(path, [])
+            while len(entries) > 0:
+                entry = entries.pop()
+                # the file was deleted or replaced (room closed and recreated)
+                # since this connection was opened, so it is no longer usable.
+                if inode is None or entry[1] != inode:
+                    stale.append(entry[0])
+                    continue
+                conn = entry[0]
+                break
+        for c in stale:
+            c.close()
+        if conn is None:
+            conn = self.connect(path)
+            conn.pool_inode = self.inode(path)
+        return conn
+    def release(self, path, conn):
+        # never hand out a connection with a transaction left open
+        conn.rollback()
+        stale = []
+        with self.lock:
+            entries = self.idle.pop(path, [])
+            entries.append([conn, getattr(conn, "pool_inode", None), time()])
+            while len(entries) > POOL_MAX_IDLE:
+                stale.append(entries.pop(0)[0])
+            # re-inserting keeps self.idle in least recently used order
+            self.idle[path] = entries
+            while len(self.idle) > POOL_MAX_DATABASES:
+                oldest = next(iter(self.idle))
+                stale += [e[0] for e in self.idle.pop(oldest)]
+        for c in stale:
+            c.close()
+    def sweep(self, now):
+        # must be called with self.lock held; returns connections to close
+        self.lastsweep = now
+        stale = []
+        for path in list(self.idle.keys()):
+            keep = [e for e in self.idle[path] if now - e[2] < POOL_IDLE_TIMEOUT]
+            stale += [e[0] for e in self.idle[path] if now - e[2] >= POOL_IDLE_TIMEOUT]
+            if len(keep) == 0:
+                del self.idle[path]
+            else:
+                self.idle[path] = keep
+        return stale
+    def discard(self, path):
+        # close every idle connection to path, e.g. before the file is removed
+        with self.lock:
+            entries = self.idle.pop(path, [])
+        for e in entries:
+            e[0].close()
+
+pool = ConnectionPool()
+pinned = threading.local()
+
+# bounded cache that drops the least recently used entry when full, and
+# entries older than ttl seconds (if ttl is not None) on lookup
+class TTLCache:
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.data = OrderedDict()   # key -> [value, time stored]
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.data.pop(key, None)
+            if entry is None:
+                return default
+            if self.ttl is not None and time() - entry[1] >= self.ttl:
+                return default
+            self.data[key] = entry
+            return entry[0]
+    def set(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = [value, time()]
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+    def pop(self, key):
+        with self.lock:
+            entry = self.data.pop(key, None)
+        return entry[0] if entry is not None else None
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+def getpinned(path):
+    return getattr(pinned, "conns", {}).get(path, None)
 
 class DBConnection:
     def __init__(self, room_db):
-        self.conn = sqlite3.connect(room_db)
+        self.room_db = room_db
+        self.pinned = getpinned(room_db)
+        if self.pinned is not None:
+            self.conn = self.pinned[0]
+        else:
+            with metrics.timer("queup_db_wait_seconds", (("op", "acquire"),)):
+                self.conn = pool.acquire(room_db)
+        self.changes = self.conn.total_changes
         self.cur = self.conn.cursor()
     def __enter__(self):
         return [self.conn, self.cur]
     def __exit__(self, type, value, traceback):
-        self.conn.commit()
-        self.conn.close()
+        self.cur.close()
+        # inside a DBTransaction the commit happens when the transaction ends
+        if self.pinned is None:
+            with metrics.timer("queup_db_wait_seconds", (("op", "commit"),)):
+                self.conn.commit()
+            changed = self.conn.total_changes != self.changes
+            pool.release(self.room_db, self.conn)
+            if changed:
+                committed(self.room_db)
+
+# every DBConnection opened on room_db by this thread inside the with block
+# shares one connection and one transaction, e.g. so that a whole chk request
+# reads a consistent view of the room. nested transactions join the outer one.
+class DBTransaction:
+    def __init__(self, room_db, immediate=False):
+        self.room_db = room_db
+        self.immediate = immediate
+    def __enter__(self):
+        if not hasattr(pinned, "conns"):
+            pinned.conns = {}
+        entry = getpinned(self.room_db)
+        if entry is None:
+            with metrics.timer("queup_db_wait_seconds", (("op", "acquire"),)):
+                conn = pool.acquire(self.room_db)
+            try:
+                with metrics.timer("queup_db_wait_seconds", (("op", "begin"),)):
+                    conn.execute("BEGIN IMMEDIATE" if self.immediate else "BEGIN")
+            except:
+                pool.release(self.room_db, conn)
+                raise
+            entry = [conn, 0, conn.total_changes]
+            pinned.conns[self.room_db] = entry
+        entry[1] += 1
+        return [entry[0], entry[0].cursor()]
+    def __exit__(self, type, value, traceback):
+        entry = getpinned(self.room_db)
+        entry[1] -= 1
+        if entry[1] > 0:
+            return
+        del pinned.conns[self.room_db]
+        changed = False
+        try:
+            if type is None:
+                with metrics.timer("queup_db_wait_seconds", (("op", "commit"),)):
+                    entry[0].commit()
+                changed = entry[0].total_changes != entry[2]
+            else:
+                entry[0].rollback()
+        finally:
+            pool.release(self.room_db, entry[0])
+        if changed:
+            committed(self.room_db)
+
+# called after every commit that changed a database
+def committed(path):
+    notifyhubs(path)
+    touchcatalog(path)
 
 # MUST be in sync with client side!
-ROOM_RGX = r'^[A-Z0-9]{5}$'
-QUEUE_RGX = r'^[a-zA-Z0-9\_]{3,15}$'
-USER_RGX = r'^[a-z0-9]{2,8}$'
-WAITDATA_RGX = r'^[a-zA-Z0-9 \,\_\'\(\)]{1,50}$'
-SUBTITLE_RGX = r'^[a-zA-Z0-9 \,\_\'\(\)\-]{1,130}$'
+ROOM_RGX = re.compile(r'^[A-Z0-9]{5}$')
+QUEUE_RGX = re.compile(r'^[a-zA-Z0-9\_]{3,15}$')
+USER_RGX = re.compile(r'^[a-z0-9]{2,8}$')
+WAITDATA_RGX = re.compile(r'^[a-zA-Z0-9 \,\_\'\(\)]{1,50}$')
+SUBTITLE_RGX = re.compile(r'^[a-zA-Z0-9 \,\_\'\(\)\-]{1,130}$')
+LEGACY_ROOM_RGX = re.compile(r'^room[A-Z0-9]{5}$')
+
+# every room database has the same fixed set of tables. queue members are rows
+# in entries rather than rows in a table per queue, so discovering queues and
+# checking membership are index lookups and the schema never changes at runtime.
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS rooms (code TEXT PRIMARY KEY, subtitle TEXT, locked INTEGER NOT NULL DEFAULT 0, cooldown INTEGER NOT NULL DEFAULT 0, version INTEGER NOT NULL DEFAULT 0)",
+    "CREATE TABLE IF NOT EXISTS owners (room TEXT NOT NULL REFERENCES rooms(code) ON DELETE CASCADE, username TEXT NOT NULL, UNIQUE (room, username))",
+    "CREATE TABLE IF NOT EXISTS queues (id INTEGER PRIMARY KEY, room TEXT NOT NULL REFERENCES rooms(code) ON DELETE CASCADE, name TEXT NOT NULL, UNIQUE (room, name))",
+    "CREATE TABLE IF NOT EXISTS entries (queue_id INTEGER NOT NULL REFERENCES queues(id) ON DELETE CASCADE, username TEXT NOT NULL, time REAL NOT NULL, data TEXT, marked INTEGER NOT NULL DEFAULT 0, UNIQUE (queue_id, username))",
+    "CREATE INDEX IF NOT EXISTS entries_queue_time ON entries (queue_id, time)",
+]
+
+# databases record the schema they were last brought up to in user_version.
+# SCHEMA_UPGRADES[v] brings a database at version v to version v + 1.
+SCHEMA_VERSION = 1
+SCHEMA_UPGRADES = {
+    0: ["ALTER TABLE rooms ADD COLUMN version INTEGER NOT NULL DEFAULT 0"],
+}
+
+def createschema(cur):
+    current = list(cur.execute("PRAGMA user_version"))[0][0]
+    fresh = len(list(cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='rooms'"))) == 0
+    for statement in SCHEMA:
+        cur.execute(statement)
+    if not fresh:
+        for v in range(current, SCHEMA_VERSION):
+            for statement in SCHEMA_UPGRADES[v]:
+                cur.execute(statement)
+    cur.execute("PRAGMA user_version = {0}".format(SCHEMA_VERSION))
+
+# every change to a room increments its version, in the same transaction, so
+# clients can tell whether they have seen the latest state of the room
+def bumpversion(cur, room):
+    cur.execute("UPDATE rooms SET version = version + 1 WHERE code == ?", (room,))
+
+# room databases created before the normalized schema have a room{R} table
+# and one room{R}_queue{Q} table per queue. migrateroom converts such a file in
+# place inside a single write transaction, so it is safe to run while the
+# room is in use; readers see either the old or the new layout, never both.
+def migrateroom(path):
+    if not os.path.exists(path):
+        raise Exception("migrateroom: " + path + " does not exist.")
+    with DBTransaction(path, immediate=True) as [conn, cur]:
+        tables = [str(row[0]) for row in cur.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+        legacy = [t for t in tables if LEGACY_ROOM_RGX.match(t)]
+        if len(legacy) == 0:
+            createschema(cur)
+            return False
+        createschema(cur)
+        for t in legacy:
+            room = t[len("room"):]
+            settings = list(cur.execute("SELECT owners, subtitle, locked, cooldown FROM {0}".format(t)))
+            owners, subtitle, locked, cooldown = settings[0] if len(settings) > 0 else (None, None, 0, 0)
+            cur.execute("INSERT OR IGNORE INTO rooms (code, subtitle, locked, cooldown) VALUES (?, ?, ?, ?)",
+                        (room, subtitle, 1 if locked == 1 else 0, int(cooldown or 0)))
+            for owner in (owners or "").split(","):
+                if owner != "":
+                    cur.execute("INSERT OR IGNORE INTO owners (room, username) VALUES (?, ?)", (room, owner))
+            for q in sorted([x[len(t + "_queue"):] for x in tables if x.startswith(t + "_queue")]):
+                cur.execute("INSERT INTO queues (room, name) VALUES (?, ?)", (room, q))
+                # the old tables had no unique key, so keep each user's earliest entry
+                cur.execute("INSERT OR IGNORE INTO entries (queue_id, username, time, data, marked) "
+                            "SELECT ?, username, time, data, CAST(marked AS INTEGER) FROM {0}_queue{1} ORDER BY time".format(t, q),
+                            (cur.lastrowid,))
+                cur.execute("DROP TABLE {0}_queue{1}".format(t, q))
+            cur.execute("DROP TABLE {0}".format(t))
+        return True
+
+# databases already checked by this process, mapped to their inode
+schemachecked = {}
+
+def ensureschema(path):
+    inode = pool.inode(path)
+    if inode is None or schemachecked.get(path, None) == inode:
+        return
+    with DBConnection(path) as [conn, cur]:
+        ready = list(cur.execute("PRAGMA user_version"))[0][0] >= SCHEMA_VERSION
+    if not ready:
+        migrateroom(path)
+    schemachecked[path] = inode
+
+# the settings and owners of a room are read on every request (owners for the
+# authorization check) but rarely change, so they are cached per process.
+# writes through the helpers below invalidate this process's copy once they
+# commit; changes made by other processes bump the room's version, so a cached
+# copy is only used while the file and version match. serve reads the version
+# once per request and passes it on; other callers leave it to be read here.
+# reads inside a transaction always go to the database.
+ROOMMETA_CACHE_TTL = 10
+roommeta_cache = TTLCache(1024, ROOMMETA_CACHE_TTL)
+
+def getroommeta(room, version=None):
+    room_db = roomdb(room)
+    cached = getpinned(room_db) is None
+    meta = roommeta_cache.get(room) if cached else None
+    if meta is not None and meta["inode"] == pool.inode(room_db) and meta["version"] == (version if version is not None else getroomversion(room)):
+        return meta
+    inode = pool.inode(room_db)
+    with DBTransaction(room_db) as [conn, cur]:
+        settings = list(cur.execute("SELECT subtitle, locked, cooldown, version FROM rooms WHERE code == ?", (room,)))
+        owners = [str(row[0]) for row in cur.execute("SELECT username FROM owners WHERE room == ? ORDER BY rowid", (room,))]
+    if len(settings) == 0:
+        # not cached, so the room is seen as soon as it is created
+        return {"subtitle": "", "locked": False, "cooldown": 0, "owners": owners}
+    meta = {"subtitle": settings[0][0], "locked": settings[0][1] == 1, "cooldown": int(settings[0][2]), "owners": owners,
+            "inode": inode, "version": settings[0][3]}
+    if cached:
+        roommeta_cache.set(room, meta)
+    return meta
 
 def createroom(room, user):
-    if not re.match(ROOM_RGX, room):
+    room_db = roomdb(room)
+    if not ROOM_RGX.match(room):
         raise Exception("createroom: Room format incorrect: " + room)
-    if "room"+room in getrooms():
+    if room in getrooms(room):
         raise Exception("createroom: Room already exists. It may be in use.")
-    with DBConnection(room_db) as [conn, cur]:
-        cur.execute("CREATE TABLE room{0} (owners TEXT, subtitle TEXT, locked INTEGER, cooldown INTEGER)".format(room))
-    # add current user as an owner
-    ownroom(room, user)
-    # create default_queue
-    createqueue("default_queue", room)
+    with DBTransaction(room_db, immediate=True) as [conn, cur]:
+        createschema(cur)
+        cur.execute("INSERT INTO rooms (code) VALUES (?)", (room,))
+        # add current user as an owner
+        ownroom(room, user)
+        # create default_queue
+        createqueue("default_queue", room)
+    schemachecked[room_db] = pool.inode(room_db)
+    roommeta_cache.pop(room)
+    directory_cache.pop(room)
+    synccatalog(room)
     # lock room by default
     # lockroom(room)
 
-def getroomsubtitle(room):
+# update the catalog after a room's owners changed, once they are committed
+def synccatalog(room):
+    if getpinned(roomdb(room)) is not None:
+        return
+    try:
+        catalogroom(room)
+    except Exception as e:
+        sys.stderr.write("queup catalog: %s: %s\n" % (room, str(e)))
+        sys.stderr.flush()
+
+def getroomsubtitle(room, version=None):
+    room_db = roomdb(room)
     if not os.path.exists(room_db):
         raise Exception("getroomsubtitle: " + room_db.split("/")[-1].replace(".db", "") + " does not exist.")
-    if not re.match(ROOM_RGX, room):
+    if not ROOM_RGX.match(room):
         raise Exception("getroomsubtitle: Room format incorrect: " + room)
-    with DBConnection(room_db) as [conn, cur]:
-        # get the subtitle
-        subtitle = list(cur.execute("SELECT subtitle FROM room{0}".format(room)))
-        if len(subtitle) == 0:
-            return ""
-        subtitle = subtitle[0]
-        return subtitle[0]
+    return getroommeta(room, version)["subtitle"]
 
 def setroomsubtitle(room, subtitle):
+    room_db = roomdb(room)
     if not os.path.exists(room_db):
         raise Exception("setroomsubtitle: " + room_db.split("/")[-1].replace(".db", "") + " does not exist.")
-    if not re.match(ROOM_RGX, room):
+    if not ROOM_RGX.match(room):
         raise Exception("setroomsubtitle: Room format incorrect: " + room)
-    if subtitle != '' and not re.match(SUBTITLE_RGX, subtitle):
+    if subtitle != '' and not SUBTITLE_RGX.match(subtitle):
         raise Exception("setroomsubtitle: Bad subtitle: " + subtitle)
     with DBConnection(room_db) as [conn, cur]:
         # set the subtitle
-        cur.execute("UPDATE room{0} SET subtitle = (?)".format(room), (subtitle,))
+        cur.execute("UPDATE rooms SET subtitle = ? WHERE code == ?", (subtitle, room))
+        bumpversion(cur, room)
+    roommeta_cache.pop(room)
 
 def lockroom(room):
+    room_db = roomdb(room)
     if not os.path.exists(room_db):
         raise Exception("lockroom: " + room_db.split("/")[-1].replace(".db", "") + " does not exist.")
-    if not re.match(ROOM_RGX, room):
+    if not ROOM_RGX.match(room):
         raise Exception("lockroom: Room format incorrect: " + room)
     with DBConnection(room_db) as [conn, cur]:
         # set the locked value to 1
-        cur.execute("UPDATE room{0} SET locked = 1".format(room))
+        cur.execute("UPDATE rooms SET locked = 1 WHERE code == ?", (room,))
+        bumpversion(cur, room)
+    roommeta_cache.pop(room)
 
 def unlockroom(room):
+    room_db = roomdb(room)
     if not os.path.exists(room_db):
         raise Exception("unlockroom: " + room_db.split("/")[-1].replace(".db", "") + " does not exist.")
-    if not re.match(ROOM_RGX, room):
+    if not ROOM_RGX.match(room):
         raise Exception("unlockroom: Room format incorrect: " + room)
     with DBConnection(room_db) as [conn, cur]:
         # set the locked value to 0
-        cur.execute("UPDATE room{0} SET locked = 0".format(room))
+        cur.execute("UPDATE rooms SET locked = 0 WHERE code == ?", (room,))
+        bumpversion(cur, room)
+    roommeta_cache.pop(room)
 
-def isroomlocked(room):
+def isroomlocked(room, version=None):
+    room_db = roomdb(room)
     if not os.path.exists(room_db):
         raise Exception("isroomlocked: " + room_db.split("/")[-1].replace(".db", "") + " does not exist.")
-    if not re.match(ROOM_RGX, room):
+    if not ROOM_RGX.match(room):
         raise Exception("isroomlocked: Room format incorrect: " + room)
-    with DBConnection(room_db) as [conn, cur]:
-        # get the locked value
-        locked = list(cur.execute("SELECT locked FROM room{0}".format(room)))
-        if len(locked) == 0:
-            return False
-        locked = locked[0]
-        return locked[0] == 1
+    return getroommeta(room, version)["locked"]
 
 def ownroom(room, newusers):
+    room_db = roomdb(room)
     if not os.path.exists(room_db):
         raise Exception("ownroom: " + room_db.split("/")[-1].replace(".db", "") + " does not exist.")
-    if not re.match(ROOM_RGX, room):
+    if not ROOM_RGX.match(room):
         raise Exception("ownroom: Room format incorrect: " + room)
     # nothing to do if no new users
     if newusers == "":
         return
-    if not all([re.match(USER_RGX, x) for x in newusers.split(",")]):
+    if not all([USER_RGX.match(x) for x in newusers.split(",")]):
         raise Exception("ownroom: Bad usernames: " + newusers)
     with DBConnection(room_db) as [conn, cur]:
-        # get old users first
-        oldusers = getowners(room)
-        # remove any repeated users
-        allusers = list(set(oldusers + newusers.split(",")))
-        if len(oldusers) == 0:
-            cur.execute("INSERT INTO room{0} (owners) VALUES (?)".format(room), (",".join(allusers),))
-        else:
-            # set owners value to str of allusers
-            cur.execute("UPDATE room{0} SET owners = (?)".format(room), (",".join(allusers),))
-            
+        # repeated users are ignored by the unique constraint
+        cur.executemany("INSERT OR IGNORE INTO owners (room, username) VALUES (?, ?)", [(room, x) for x in newusers.split(",")])
+        bumpversion(cur, room)
+    roommeta_cache.pop(room)
+    synccatalog(room)
+
 def delownroom(room, delusers):
+    room_db = roomdb(room)
     if not os.path.exists(room_db):
         raise Exception("delownroom: " + room_db.split("/")[-1].replace(".db", "") + " does not exist.")
-    if not re.match(ROOM_RGX, room):
+    if not ROOM_RGX.match(room):
         raise Exception("delownroom: Room format incorrect: " + room)
     # nothing to do if no new users
     if delusers == "":
         return
-    if not all([re.match(USER_RGX, x) for x in delusers.split(",")]):
+    if not all([USER_RGX.match(x) for x in delusers.split(",")]):
         raise Exception("delownroom: Bad usernames: " + delusers)
-    with DBConnection(room_db) as [conn, cur]:
+    with DBTransaction(room_db, immediate=True) as [conn, cur]:
         # get old users first
         oldusers = getowners(room)
         # remove users that are in delusers
         allusers = [x for x in oldusers if str(x) not in delusers.split(",")]
         if len(allusers) == 0:
-            # cur.execute("INSERT INTO room{0} (owners) VALUES (?)".format(room), (",".join(allusers),))
             raise Exception("The room cannot have no owners!")
-        else:
-            # set owners value to str of allusers
-            cur.execute("UPDATE room{0} SET owners = (?)".format(room), (",".join(allusers),))
+        cur.executemany("DELETE FROM owners WHERE room == ? AND username == ?", [(room, x) for x in delusers.split(",")])
+        bumpversion(cur, room)
+    roommeta_cache.pop(room)
+    synccatalog(room)
 
-def getowners(room):
+def getowners(room, version=None):
+    room_db = roomdb(room)
     if not os.path.exists(room_db):
         return []
-    if not re.match(ROOM_RGX, room):
+    if not ROOM_RGX.match(room):
         raise Exception("getowners: Room format incorrect: " + room)
-    with DBConnection(room_db) as [conn, cur]:
-        allusers = list(cur.execute("SELECT owners FROM room{0}".format(room)))
-        if len(allusers) == 0:
-            return []
-        allusers = allusers[0]
-        allusers = allusers[0].split(",")
-        return allusers
+    return list(getroommeta(room, version)["owners"])
 
 def deleteroom(room):
+    room_db = roomdb(room)
     if not os.path.exists(room_db):
         raise Exception("deleteroom: " + room_db.split("/")[-1].replace(".db", "") + " does not exist.")
-    if not re.match(ROOM_RGX, room):
+    if not ROOM_RGX.match(room):
         raise Exception("deleteroom: Room format incorrect: " + room)
-    # find queues associated with room
-    queues = getqueues(room)
-    # delete all queues associated with room
-    for queue in queues:
-        deletequeue(queue, room)
-    # delete the room from the db (IMPORTANT as it triggers sseupdate to close client-side)
+    # delete the room from the db, which also deletes its owners, queues and
+    # queue members (IMPORTANT as it triggers sseupdate to close client-side)
     with DBConnection(room_db) as [conn, cur]:
-        cur.execute("DROP TABLE room{0}".format(room))
-    # finally, delete the room database file
-    os.remove(room_db)
+        cur.execute("DELETE FROM rooms WHERE code == ?", (room,))
+    # finally, delete the room database file along with its WAL files
+    removeroomdb(room_db)
+    try:
+        uncatalogroom(room)
+    except Exception as e:
+        sys.stderr.write("queup catalog: %s: %s\n" % (room, str(e)))
+        sys.stderr.flush()
+
+def removeroomdb(path):
+    pool.discard(path)
+    schemachecked.pop(path, None)
+    roommeta_cache.pop(os.path.basename(path).replace(".db", ""))
+    directory_cache.pop(os.path.basename(path).replace(".db", ""))
+    for is_owner in [True, False]:
+        snapshot_cache.pop((os.path.basename(path).replace(".db", ""), is_owner))
+    for f in [path, path + "-wal", path + "-shm"]:
+        if os.path.exists(f):
+            os.remove(f)
 
 def createqueue(queue, room):
+    room_db = roomdb(room)
     if not os.path.exists(room_db):
         raise Exception("createqueue: " + room_db.split("/")[-1].replace(".db", "") + " does not exist.")
-    with DBConnection(room_db) as [conn, cur]:
-        if "room" + room not in [x[0] for x in cur.execute("SELECT name FROM sqlite_master WHERE type='table'")]:
+    with DBTransaction(room_db, immediate=True) as [conn, cur]:
+        if len(list(cur.execute("SELECT 1 FROM rooms WHERE code == ?", (room,)))) == 0:
             raise Exception("The room {0} did not exist.".format(room))
-        if not re.match(QUEUE_RGX, queue):
+        if not QUEUE_RGX.match(queue):
             raise Exception("createqueue: Bad queue name: " + queue)
-        # ensure queue table does not exist already
-        # makes sure that anyone on there is no longer there
-        if "room" + room + "_queue" + queue in [x[0] for x in cur.execute("SELECT name FROM sqlite_master WHERE type='table'")]:
-            deletequeue(queue, room)
-        # create the queue table
-        cur.execute("CREATE TABLE room{0}_queue{1} (username TEXT KEY, time REAL, data TEXT, marked INTEGER)".format(room, queue))
-        return True
+        # if the queue exists already, recreate it so that anyone
+        # on there is no longer there
+        cur.execute("DELETE FROM queues WHERE room == ? AND name == ?", (room, queue))
+        # create the queue
+        cur.execute("INSERT INTO queues (room, name) VALUES (?, ?)", (room, queue))
+        bumpversion(cur, room)
+    directory_cache.pop(room)
+    return True
 
 def renamequeue(oldqueue, newqueue, room):
+    room_db = roomdb(room)
     if not os.path.exists(room_db):
         raise Exception("renamequeue: " + room_db.split("/")[-1].replace(".db", "") + " does not exist.")
+    if not ROOM_RGX.match(room):
+        raise Exception("renamequeue: Room format incorrect: " + room)
+    if not QUEUE_RGX.match(newqueue):
+        raise Exception("renamequeue: Bad queue name: " + newqueue)
     with DBConnection(room_db) as [conn, cur]:
-        # ensure queue table exists
-        if "room" + room + "_queue" + oldqueue not in [x[0] for x in cur.execute("SELECT name FROM sqlite_master WHERE type='table'")]:
+        # rename the queue, which must exist
+        cur.execute("UPDATE queues SET name = ? WHERE room == ? AND name == ?", (newqueue, room, oldqueue))
+        if cur.rowcount == 0:
             raise Exception("renamequeue: Queue {0} did not exist.".format(oldqueue))
-        if not re.match(ROOM_RGX, room):
-            raise Exception("renamequeue: Room format incorrect: " + room)
-        if not re.match(QUEUE_RGX, newqueue):
-            raise Exception("renamequeue: Bad queue name: " + newqueue)
-        # create the queue table
-        cur.execute("ALTER TABLE room{0}_queue{1} RENAME TO room{0}_queue{2}".format(room, oldqueue, newqueue))
-        return True
+        bumpversion(cur, room)
+    directory_cache.pop(room)
+    return True
 
 def deletequeue(queue, room):
+    room_db = roomdb(room)
     if not os.path.exists(room_db):
         raise Exception("deletequeue: " + room_db.split("/")[-1].replace(".db", "") + " does not exist.")
-    if not re.match(ROOM_RGX, room):
+    if not ROOM_RGX.match(room):
         raise Exception("deletequeue: Room format incorrect: " + room)
-    elif not re.match(QUEUE_RGX, queue):
+    elif not QUEUE_RGX.match(queue):
         raise Exception("deletequeue: Bad queue name: " + queue)
     with DBConnection(room_db) as [conn, cur]:
-        # delete the queue table if it exists
-        if "room" + room + "_queue" + queue in [x[0] for x in cur.execute("SELECT name FROM sqlite_master WHERE type='table'")]:
-            cur.execute("DROP TABLE room{0}_queue{1}".format(room, queue))
+        # delete the queue and its members if it exists
+        cur.execute("DELETE FROM queues WHERE room == ? AND name == ?", (room, queue))
+        bumpversion(cur, room)
+    directory_cache.pop(room)
 
 def setcooldown(cooldown, room):
+    room_db = roomdb(room)
     if not os.path.exists(room_db):
         raise Exception("setcooldown: " + room_db.split("/")[-1].replace(".db", "") + " does not exist.")
-    if not re.match(ROOM_RGX, room):
+    if not ROOM_RGX.match(room):
         raise Exception("setcooldown: Room format incorrect: " + room)
     with DBConnection(room_db) as [conn, cur]:
         # set the cooldown value
-        cur.execute("UPDATE room{0} SET cooldown = ?".format(room), (str(cooldown),))
-    
-def getcooldown(room):
+        cur.execute("UPDATE rooms SET cooldown = ? WHERE code == ?", (int(cooldown), room))
+        bumpversion(cur, room)
+    roommeta_cache.pop(room)
+
+def getcooldown(room, version=None):
+    room_db = roomdb(room)
     if not os.path.exists(room_db):
         raise Exception("getcooldown: " + room_db.split("/")[-1].replace(".db", "") + " does not exist.")
-    if not re.match(ROOM_RGX, room):
+    if not ROOM_RGX.match(room):
         raise Exception("getcooldown: Room format incorrect: " + room)
-    with DBConnection(room_db) as [conn, cur]:
-        # get the cooldown value
-        cooldown = list(cur.execute("SELECT cooldown FROM room{0}".format(room)))
-        if len(cooldown) == 0:
-            return 0
-        if cooldown[0][0] == None:
-            setcooldown(0, room)
-            cooldown = 0
-        else:
-            cooldown = int(cooldown[0][0])
-        return cooldown
+    return getroommeta(room, version)["cooldown"]
 
 def addquser(user, waitdata, queue, room):
+    room_db = roomdb(room)
     if not os.path.exists(room_db):
         raise Exception("addquser: " + room_db.split("/")[-1].replace(".db", "") + " does not exist.")
     if queue == "":
         raise Exception("addquser: No queue provided")
     elif room == "":
         raise Exception("addquser: No room provided")
-    elif not re.match(ROOM_RGX, room):
+    elif not ROOM_RGX.match(room):
         raise Exception("addquser: Room format incorrect: " + room)
-    elif not re.match(QUEUE_RGX, queue):
+    elif not QUEUE_RGX.match(queue):
         raise Exception("addquser: Bad queue name: " + queue)
-    elif not re.match(USER_RGX, user):
+    elif not USER_RGX.match(user):
         raise Exception("addquser: Bad username: " + user)
-    elif waitdata != '' and not re.match(WAITDATA_RGX, waitdata):
+    elif waitdata != '' and not WAITDATA_RGX.match(waitdata):
         raise Exception("addquser: Bad waitdata: " + waitdata)
     with DBConnection(room_db) as [conn, cur]:
-        cur.execute("INSERT INTO room{0}_queue{1} (username, time, data, marked) VALUES (?, ?, ?, ?)".format(room, queue), (user, time(), waitdata, '0'))
+        # raises sqlite3.IntegrityError if the user is already in the queue
+        cur.execute("INSERT INTO entries (queue_id, username, time, data, marked) SELECT id, ?, ?, ?, 0 FROM queues WHERE room == ? AND name == ?", (user, time(), waitdata, room, queue))
+        if cur.rowcount == 0:
+            raise Exception("addquser: Queue {0} did not exist.".format(queue))
+        bumpversion(cur, room)
 
 def delquser(user, queue, room):
+    room_db = roomdb(room)
     if not os.path.exists(room_db):
         raise Exception("delquser: " + room_db.split("/")[-1].replace(".db", "") + " does not exist.")
     if queue == "":
         raise Exception("delquser: No queue provided")
     elif room == "":
         raise Exception("delquser: No room provided")
-    elif not re.match(ROOM_RGX, room):
+    elif not ROOM_RGX.match(room):
         raise Exception("delquser: Room format incorrect: " + room)
-    elif not re.match(QUEUE_RGX, queue):
+    elif not QUEUE_RGX.match(queue):
         raise Exception("delquser: Bad queue name: " + queue)
-    elif not re.match(USER_RGX, user):
+    elif not USER_RGX.match(user):
         raise Exception("delquser: Bad username: " + user)
     with DBConnection(room_db) as [conn, cur]:
-        cur.execute("DELETE FROM room{0}_queue{1} WHERE username == ?".format(room, queue), (user,))
+        cur.execute("DELETE FROM entries WHERE queue_id == (SELECT id FROM queues WHERE room == ? AND name == ?) AND username == ?", (room, queue, user))
+        if cur.rowcount > 0:
+            bumpversion(cur, room)
 
-def getrooms():
+# remove every user from a queue in one statement, and so one commit
+def clearqueue(queue, room):
+    room_db = roomdb(room)
     if not os.path.exists(room_db):
-        return []
+        raise Exception("clearqueue: " + room_db.split("/")[-1].replace(".db", "") + " does not exist.")
+    if queue == "":
+        raise Exception("clearqueue: No queue provided")
+    elif room == "":
+        raise Exception("clearqueue: No room provided")
+    elif not ROOM_RGX.match(room):
+        raise Exception("clearqueue: Room format incorrect: " + room)
+    elif not QUEUE_RGX.match(queue):
+        raise Exception("clearqueue: Bad queue name: " + queue)
     with DBConnection(room_db) as [conn, cur]:
-        # get all rooms, then get all room data
-        with conn:
-            roomnames = [str(row[0]) for row in cur.execute('SELECT name FROM sqlite_master') if row[0].startswith("room") and "queue" not in row[0]]
-        return roomnames
+        cur.execute("DELETE FROM entries WHERE queue_id == (SELECT id FROM queues WHERE room == ? AND name == ?)", (room, queue))
+        cleared = cur.rowcount
+        if cleared > 0:
+            bumpversion(cur, room)
+        return cleared
+
+# what exists in a room's database: its rooms (the room itself, once created)
+# and the room's queues, as sets for the handler's membership checks. kept
+# per process like the room metadata and checked against the room's version
+# (and the file's inode) on every lookup, so queue changes made by other
+# processes are seen at once; changes made here also invalidate it.
+DIRECTORY_CACHE_TTL = 10
+directory_cache = TTLCache(1024, DIRECTORY_CACHE_TTL)
+
+class RoomDirectory:
+    def __init__(self, inode, version, rooms, queues):
+        self.inode = inode
+        self.version = version
+        self.rooms = set(rooms)
+        self.queues = set(queues)
+        self.names = list(queues)   # the queues in name order
+
+def getdirectory(room, version=None):
+    room_db = roomdb(room)
+    inode = pool.inode(room_db)
+    if inode is None:
+        return RoomDirectory(None, None, [], [])
+    cached = getpinned(room_db) is None
+    directory = directory_cache.get(room) if cached else None
+    # other processes change queues too, and every change bumps the room's
+    # version, so a cached directory is only used while the version matches
+    # (the caller's, if it has read it already)
+    if directory is not None and directory.inode == inode and directory.version == (version if version is not None else getroomversion(room)):
+        return directory
+    with DBTransaction(room_db) as [conn, cur]:
+        rooms = [str(row[0]) for row in cur.execute("SELECT code FROM rooms")]
+        queues = [str(row[0]) for row in cur.execute("SELECT name FROM queues WHERE room == ? ORDER BY name", (room,))]
+        version = list(cur.execute("SELECT version FROM rooms WHERE code == ?", (room,)))
+    directory = RoomDirectory(inode, version[0][0] if len(version) > 0 else None, rooms, queues)
+    if cached:
+        directory_cache.set(room, directory)
+    return directory
+
+# the rooms stored in the database of room: [room] if it exists, else []
+def getrooms(room):
+    return sorted(getdirectory(room).rooms)
 
 def getqueues(room):
+    room_db = roomdb(room)
     if not os.path.exists(room_db):
         raise Exception("getqueues: " + room_db.split("/")[-1].replace(".db", "") + " does not exist.")
+    return list(getdirectory(room).names)
+
+def isinqueue(user, queue, room):
+    room_db = roomdb(room)
+    if not os.path.exists(room_db):
+        raise Exception("isinqueue: " + room_db.split("/")[-1].replace(".db", "") + " does not exist.")
     with DBConnection(room_db) as [conn, cur]:
-        if room == "":
-            return [row[0] for row in cur.execute("SELECT name FROM sqlite_master") if re.match(r'room[A-Z0-9]{5}_queue.*', row[0])]
-        else:
-            # get all queues in room
-            return [str(row[0].replace("room{0}_queue".format(room), "")) for row in cur.execute("SELECT name FROM sqlite_master") if row[0].startswith("room{0}_queue".format(room))]
-
-def getlastadd(room, username):
-    if not os.path.exists(private + "room.log"):
-        return 0    # no one could have added themselves to this queue at UNIX epoch!
-    with open(private + "room.log", "r") as f:
-        data = [x.split(",") for x in f.read().split("\n") if room in x and username in x and "uadd" in x]
-    if len(data) == 0:
-        return 0    # no one could have added themselves to this queue at UNIX epoch!
-    return float(data[-1][0])   # but we can find out when they did it last
-
-def getusers(queue, room):
+        return len(list(cur.execute("SELECT 1 FROM entries JOIN queues ON queues.id == entries.queue_id WHERE queues.room == ? AND queues.name == ? AND entries.username == ?", (room, queue, user)))) > 0
+
+# (room, username) -> time of their last uadd, written through by the log writer.
+# another process may have logged a newer add, so a cached time is never newer
+# than the real one: it is trusted when it already falls within the cooldown
+# window the caller checks (so repeated attempts are refused from memory), and
+# otherwise the newer of it and the log store's time is used.
+lastadd_cache = TTLCache(8192)
+
+def getlastadd(room, username, within=None):
+    cached = lastadd_cache.get((room, username))
+    if cached is not None and within is not None and time() - cached < within:
+        return cached
+    # adds still queued in this process's log writer are already in the cache
+    if not os.path.exists(private + LOG_DB):
+        return cached or 0  # no one could have added themselves to this queue at UNIX epoch!
+    with DBConnection(openlogdb()) as [conn, cur]:
+        lastadd = list(cur.execute("SELECT max(time) FROM log WHERE room == ? AND user == ? AND action == 'uadd'", (room, username)))
+    if lastadd[0][0] is None:
+        return cached or 0  # no one could have added themselves to this queue at UNIX epoch!
+    lastadd = max(lastadd[0][0], cached or 0)
+    lastadd_cache.set((room, username), lastadd)
+    return lastadd          # but we can find out when they did it last
+
+# the complete state of a room, read on one connection in three queries:
+# the room settings, its owners, and every queue with its members.
+# this is what chk returns and what every connected browser is sent.
+def getroomsnapshot(room):
+    room_db = roomdb(room)
+    with metrics.timer("queup_phase_seconds", (("phase", "snapshot"),)):
+        return readroomsnapshot(room_db, room)
+
+# the room's version alone, e.g. to tell whether a client's snapshot is current
+def getroomversion(room):
+    room_db = roomdb(room)
     if not os.path.exists(room_db):
-        raise Exception("getusers: " + room_db.split("/")[-1].replace(".db", "") + " does not exist.")
+        return None
     with DBConnection(room_db) as [conn, cur]:
-        # we don't need to check if room == "" because getqueues does that for us
-        if queue == "":
-            queues = sorted(getqueues(room))
-            all_users = {}
-            for _q in queues:
-                if room == "":
-                    r = _q.split("_")[0].replace("room", "")
-                else:
-                    r = room
-                q = _q
-                if r not in all_users:
-                    all_users[r] = {}
-                all_users[r][q] = sorted([row for row in cur.execute("SELECT username, time, data, marked FROM room{0}_queue{1}".format(r, q))])
-            return all_users
-        else:
-            # get all users in queue
-            return sorted([row for row in cur.execute("SELECT username, time, data, marked FROM room{0}_queue{1}".format(room, queue))])
+        rows = list(cur.execute("SELECT version FROM rooms WHERE code == ?", (room,)))
+    return rows[0][0] if len(rows) > 0 else None
+
+def readroomsnapshot(path, room):
+    if not os.path.exists(path):
+        raise Exception("getroomsnapshot: " + path.split("/")[-1].replace(".db", "") + " does not exist.")
+    if not ROOM_RGX.match(room):
+        raise Exception("getroomsnapshot: Room format incorrect: " + room)
+    with DBTransaction(path) as [conn, cur]:
+        settings = list(cur.execute("SELECT subtitle, locked, cooldown, version FROM rooms WHERE code == ?", (room,)))
+        owners = [str(row[0]) for row in cur.execute("SELECT username FROM owners WHERE room == ? ORDER BY rowid", (room,))]
+        rows = list(cur.execute("SELECT queues.name, entries.username, entries.time, entries.data, entries.marked FROM queues "
+                                "LEFT JOIN entries ON entries.queue_id == queues.id WHERE queues.room == ? "
+                                "ORDER BY queues.name, entries.time", (room,)))
+    if len(settings) == 0:
+        raise Exception("getroomsnapshot: Room {0} does not exist.".format(room))
+    snapshot = {room: {}}
+    for row in rows:
+        if row[0] not in snapshot[room]:
+            snapshot[room][row[0]] = []
+        if row[1] is not None:
+            snapshot[room][row[0]].append(list(row[1:]))
+    subtitle, locked, cooldown, version = settings[0]
+    snapshot["version"] = version
+    snapshot["cooldown"] = cooldown
+    snapshot["owners"] = owners
+    snapshot["subtitle"] = subtitle
+    snapshot["is-locked"] = locked == 1
+    snapshot["is-permanent"] = getroompermanency(room)
+    return snapshot
+
+# what a given user may see of a snapshot: only owners get the owner list
+def viewsnapshot(snapshot, is_owner):
+    view = dict(snapshot)
+    view["is-owner"] = is_owner
+    if not is_owner:
+        del view["owners"]
+    return view
+
+# encoded room snapshots, so that one change to a room is read and encoded
+# once no matter how many clients ask for it: chk responses, the responses to
+# owners' changes and the room's sseupdate stream all share them. there is an
+# entry per room and view (owner or not), valid for one version of the room
+# database file (a room closed and created again is a new file).
+SNAPSHOT_CACHE_TTL = 60
+snapshot_cache = TTLCache(1024, SNAPSHOT_CACHE_TTL)     # (room, is_owner) -> [inode, version, permanent, json]
+
+def encodejson(obj):
+    # mod_python's query values are a subclass of str, which orjson only
+    # takes as dict keys with OPT_NON_STR_KEYS; anything else it cannot
+    # encode is left to the json module
+    try:
+        if orjson is not None:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+        if ujson is not None:
+            return ujson.dumps(obj)
+    except (TypeError, OverflowError, ValueError):
+        pass
+    return json.dumps(obj)
+
+# encode a view of a room snapshot and keep it for the next request
+def cachesnapshot(room, inode, view):
+    with metrics.timer("queup_phase_seconds", (("phase", "json"),)):
+        data = encodejson(view)
+    snapshot_cache.set((room, view["is-owner"]), [inode, view["version"], view["is-permanent"], data])
+    return data
+
+# a room's version and its snapshot as a given user sees it, as JSON. inside a
+# transaction on the room, the snapshot may never be committed, so it is not
+# cached.
+def getroomjson(room, is_owner, version=None):
+    if getpinned(roomdb(room)) is not None:
+        view = viewsnapshot(getroomsnapshot(room), is_owner)
+        return view["version"], dumps(view)
+    inode = pool.inode(roomdb(room))
+    if version is None:
+        version = getroomversion(room)
+    entry = snapshot_cache.get((room, is_owner))
+    if entry is not None and entry[:3] == [inode, version, getroompermanency(room)]:
+        metrics.count("queup_snapshot_cache_total", (("result", "hit"),))
+        return version, entry[3]
+    metrics.count("queup_snapshot_cache_total", (("result", "miss"),))
+    view = viewsnapshot(getroomsnapshot(room), is_owner)
+    return view["version"], cachesnapshot(room, inode, view)
 
 def togglemark(user, queue, room):
+    room_db = roomdb(room)
     if not os.path.exists(room_db):
         raise Exception("togglemark: " + room_db.split("/")[-1].replace(".db", "") + " does not exist.")
     if queue == "":
         raise Exception("togglemark: No queue provided")
     elif room == "":
         raise Exception("togglemark: No room provided")
-    elif not re.match(ROOM_RGX, room):
+    elif not ROOM_RGX.match(room):
         raise Exception("togglemark: Room format incorrect: " + room)
-    elif not re.match(QUEUE_RGX, queue):
+    elif not QUEUE_RGX.match(queue):
         raise Exception("togglemark: Bad queue name: " + queue)
-    elif not re.match(USER_RGX, user):
+    elif not USER_RGX.match(user):
         raise Exception("togglemark: Bad username: " + user)
     with DBConnection(room_db) as [conn, cur]:
-        # get the marked value
-        marked = list(cur.execute("SELECT marked FROM room{0}_queue{1} WHERE username == ?".format(room, queue), (user,)))
-        # if marked is empty, then user is not in queue
-        if len(marked) == 0:
-            raise Exception("togglemark: User {0} not in queue {1} in room {2}".format(user, queue, room))
-        marked = marked[0]
         # toggle the marked value
-        cur.execute("UPDATE room{0}_queue{1} SET marked = ? WHERE username == ?".format(room, queue), (1 - int(marked[0]), user))
+        cur.execute("UPDATE entries SET marked = 1 - marked WHERE queue_id == (SELECT id FROM queues WHERE room == ? AND name == ?) AND username == ?", (room, queue, user))
+        # if nothing was updated, then user is not in queue
+        if cur.rowcount == 0:
+            raise Exception("togglemark: User {0} not in queue {1} in room {2}".format(user, queue, room))
+        bumpversion(cur, room)
+        return True
+
+# move a user to another queue of the same room, keeping their place in line
+# (the time they joined) unless keeptime is False
+def moveuser(user, queue, newqueue, room, keeptime=True):
+    room_db = roomdb(room)
+    if not os.path.exists(room_db):
+        raise Exception("moveuser: " + room_db.split("/")[-1].replace(".db", "") + " does not exist.")
+    if queue == "" or newqueue == "":
+        raise Exception("moveuser: No queue provided")
+    elif not ROOM_RGX.match(room):
+        raise Exception("moveuser: Room format incorrect: " + room)
+    elif not QUEUE_RGX.match(queue):
+        raise Exception("moveuser: Bad queue name: " + queue)
+    elif not QUEUE_RGX.match(newqueue):
+        raise Exception("moveuser: Bad queue name: " + newqueue)
+    elif not USER_RGX.match(user):
+        raise Exception("moveuser: Bad username: " + user)
+    elif queue == newqueue:
+        raise Exception("moveuser: User {0} is already in queue {1}".format(user, queue))
+    with DBConnection(room_db) as [conn, cur]:
+        target = list(cur.execute("SELECT id FROM queues WHERE room == ? AND name == ?", (room, newqueue)))
+        if len(target) == 0:
+            raise Exception("moveuser: Queue {0} did not exist.".format(newqueue))
+        # raises sqlite3.IntegrityError if the user is already in newqueue
+        if keeptime:
+            cur.execute("UPDATE entries SET queue_id = ? WHERE queue_id == (SELECT id FROM queues WHERE room == ? AND name == ?) AND username == ?",
+                        (target[0][0], room, queue, user))
+        else:
+            cur.execute("UPDATE entries SET queue_id = ?, time = ? WHERE queue_id == (SELECT id FROM queues WHERE room == ? AND name == ?) AND username == ?",
+                        (target[0][0], time(), room, queue, user))
+        if cur.rowcount == 0:
+            raise Exception("moveuser: User {0} not in queue {1} in room {2}".format(user, queue, room))
+        bumpversion(cur, room)
         return True
 
+# owners can send several queue operations at once (action=batch), as a JSON
+# list in the ops field:
+#   ["add", queue, user]             add user to queue
+#   ["del", queue, user]             remove user from queue
+#   ["mark", queue, user]            toggle user's mark
+#   ["move", queue, user, newqueue]  move user to newqueue, keeping their place
+#   ["clear", queue]                 remove everyone from queue
+# they are all checked before any is run, and then run in one transaction, so
+# either all of them happen or none do.
+BATCH_MAX_OPS = 500
+BATCH_ARGS = {"add": 2, "del": 2, "mark": 2, "move": 3, "clear": 1}
+
+def parsebatch(data, queues):
+    try:
+        ops = json.loads(data)
+    except ValueError:
+        raise Exception("parsebatch: ops is not valid JSON")
+    if not isinstance(ops, list) or len(ops) == 0 or len(ops) > BATCH_MAX_OPS:
+        raise Exception("parsebatch: ops must be a list of 1 to {0} operations".format(BATCH_MAX_OPS))
+    for op in ops:
+        if not isinstance(op, list) or len(op) == 0 or op[0] not in BATCH_ARGS or len(op) != BATCH_ARGS[op[0]] + 1:
+            raise Exception("parsebatch: Bad operation: " + json.dumps(op))
+        if not all([isinstance(x, type(u"")) for x in op]):
+            raise Exception("parsebatch: Bad operation: " + json.dumps(op))
+        if op[1] not in queues:
+            raise Exception("parsebatch: Queue {0} does not exist.".format(op[1]))
+        if len(op) > 2 and not USER_RGX.match(op[2]):
+            raise Exception("parsebatch: Bad username: " + op[2])
+        if op[0] == "move" and op[3] not in queues:
+            raise Exception("parsebatch: Queue {0} does not exist.".format(op[3]))
+    return [[str(x) for x in op] for op in ops]
+
+def runbatch(ops, room):
+    with DBTransaction(roomdb(room), immediate=True) as [conn, cur]:
+        for op in ops:
+            if op[0] == "add":
+                addquser(op[2], "", op[1], room)
+            elif op[0] == "del":
+                delquser(op[2], op[1], room)
+            elif op[0] == "mark":
+                togglemark(op[2], op[1], room)
+            elif op[0] == "move":
+                moveuser(op[2], op[1], op[3], room)
+            elif op[0] == "clear":
+                clearqueue(op[1], room)
+    return True
+
+# nodel_rooms lists the permanent rooms and metrics_users the users allowed to
+# read the metrics, one per line. they are edited by hand, so each is only
+# read again once its size, mtime or inode change.
+listfiles = {}          # path -> [(inode, size, mtime) of the file, lines]
+listfiles_lock = threading.Lock()
+
+def readlistfile(name):
+    path = private + name
+    try:
+        st = os.stat(path)
+    except OSError:
+        return set()
+    key = (st.st_ino, st.st_size, st.st_mtime)
+    with listfiles_lock:
+        entry = listfiles.get(path, None)
+        if entry is None or entry[0] != key:
+            with open(path, "r") as f:
+                entry = listfiles[path] = [key, set([x.strip() for x in f.read().split("\n") if x.strip() != ""])]
+        return entry[1]
+
 def getroompermanency(room):
-    if not os.path.exists(private + "nodel_rooms"):
-        return False
-    with open(private + "nodel_rooms", "r") as f:
-        return room in f.read().split("\n")
+    return room in readlistfile("nodel_rooms")
+
+# file locks are held with flock, so the kernel releases them when the holder
+# exits or crashes and a lock can never be left behind. waiting is done in
+# LOCK_POLL steps instead of whole seconds. without fcntl, an O_EXCL lock file
+# older than LOCK_TIMEOUT is treated as left behind by a crashed holder.
+LOCK_TIMEOUT = 5
+LOCK_POLL = 0.01
 
 def acquireLock(path):
-    t = 0
-    while t < 5 and os.path.exists(path + ".lck"):
-        sleep(1)
-        t += 1
-    if t == 5:
-        raise Exception("lockdir " + path + ".lck" + " not removed.")
-    try:
-        os.mkdir(path + ".lck")
-    except:
-        raise Exception("Unable to create lockdir")
-    return path + ".lck"
+    with metrics.timer("queup_lock_wait_seconds"):
+        return waitLock(path)
+
+def waitLock(path):
+    # lock directories made by older versions may have been left behind
+    if os.path.isdir(path + ".lck") and time() - os.path.getmtime(path + ".lck") > LOCK_TIMEOUT:
+        shutil.rmtree(path + ".lck", ignore_errors=True)
+    deadline = time() + LOCK_TIMEOUT
+    if fcntl is not None:
+        fd = os.open(path + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except (IOError, OSError):
+                if time() > deadline:
+                    os.close(fd)
+                    raise Exception("Unable to lock " + path + ".lock")
+                sleep(LOCK_POLL)
+    while True:
+        try:
+            os.close(os.open(path + ".lock", os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+            return path + ".lock"
+        except OSError:
+            try:
+                if time() - os.path.getmtime(path + ".lock") > LOCK_TIMEOUT:
+                    os.remove(path + ".lock")
+                    continue
+            except OSError:
+                continue
+            if time() > deadline:
+                raise Exception("Unable to lock " + path + ".lock")
+            sleep(LOCK_POLL)
 
 def releaseLock(lock):
-    if os.path.exists(lock):
+    if fcntl is not None:
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        os.close(lock)
+    elif os.path.exists(lock):
         try:
-            shutil.rmtree(lock)
+            os.remove(lock)
         except:
-            raise Exception("Unable to remove lockdir")
+            raise Exception("Unable to remove lock " + lock)
+
+# catalog.db indexes every room: when it was created and last changed, the
+# size of its database, and its owners (indexed by username). the room
+# databases stay the only source of truth and are written independently; the
+# catalog follows them, so that listing rooms, finding the rooms a user owns
+# and finding idle rooms are queries instead of opening every room database.
+# "queupctl.py catalog --rebuild" recreates it from the room databases.
+#
+# a room's activity is recorded at most once every CATALOG_TOUCH_INTERVAL
+# seconds per process, so lastactive may lag by that much.
+CATALOG_DB = "catalog.db"
+CATALOG_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS rooms (code TEXT PRIMARY KEY, created REAL NOT NULL, lastactive REAL NOT NULL, size INTEGER NOT NULL DEFAULT 0)",
+    "CREATE TABLE IF NOT EXISTS owners (room TEXT NOT NULL REFERENCES rooms (code) ON DELETE CASCADE, username TEXT NOT NULL, UNIQUE (room, username))",
+    "CREATE INDEX IF NOT EXISTS owners_username ON owners (username)",
+    "CREATE INDEX IF NOT EXISTS rooms_lastactive ON rooms (lastactive)",
+]
+CATALOG_TOUCH_INTERVAL = 60
+catalogchecked = set()
+catalog_touched = TTLCache(4096, CATALOG_TOUCH_INTERVAL)
+
+def opencatalog():
+    path = private + CATALOG_DB
+    if path not in catalogchecked or not os.path.exists(path):
+        with DBConnection(path) as [conn, cur]:
+            for statement in CATALOG_SCHEMA:
+                cur.execute(statement)
+        catalogchecked.add(path)
+    return path
+
+def roomdbsize(room):
+    size = 0
+    for f in [roomdb(room), roomdb(room) + "-wal"]:
+        try:
+            size += os.path.getsize(f)
+        except OSError:
+            pass
+    return size
+
+# bring the catalog entry of a room up to date with its database
+def catalogroom(room, created=None, lastactive=None):
+    now = time()
+    owners = getowners(room)
+    with DBTransaction(opencatalog(), immediate=True) as [conn, cur]:
+        cur.execute("INSERT OR IGNORE INTO rooms (code, created, lastactive) VALUES (?, ?, ?)",
+                    (room, created if created is not None else now, lastactive if lastactive is not None else now))
+        cur.execute("UPDATE rooms SET lastactive = max(lastactive, ?), size = ? WHERE code == ?",
+                    (lastactive if lastactive is not None else now, roomdbsize(room), room))
+        cur.execute("DELETE FROM owners WHERE room == ?", (room,))
+        cur.executemany("INSERT OR IGNORE INTO owners (room, username) VALUES (?, ?)", [(room, x) for x in owners])
+    catalog_touched.set(room, now)
+
+def uncatalogroom(room):
+    with DBConnection(opencatalog()) as [conn, cur]:
+        cur.execute("DELETE FROM rooms WHERE code == ?", (room,))
+    catalog_touched.pop(room)
+
+# record activity in a room database that was just committed to
+def touchcatalog(path):
+    if not path.startswith(private + "rooms/") or not path.endswith(".db"):
+        return
+    room = os.path.basename(path)[:-len(".db")]
+    if catalog_touched.get(room) is not None or not os.path.exists(path):
+        return
+    catalog_touched.set(room, time())
+    try:
+        with DBConnection(opencatalog()) as [conn, cur]:
+            cur.execute("UPDATE rooms SET lastactive = ?, size = ? WHERE code == ?", (time(), roomdbsize(room), room))
+            missing = cur.rowcount == 0
+        if missing:
+            catalogroom(room)
+    except Exception as e:
+        # the catalog is only an index; never fail a request over it
+        sys.stderr.write("queup catalog: %s: %s\n" % (room, str(e)))
+        sys.stderr.flush()
+
+# rooms from the catalog as [code, created, lastactive, size, [owners]],
+# optionally only those owned by owner or not changed for idle seconds
+def listrooms(owner=None, idle=None):
+    where, params = [], []
+    if owner is not None:
+        where.append("code IN (SELECT room FROM owners WHERE username == ?)")
+        params.append(owner)
+    if idle is not None:
+        where.append("lastactive < ?")
+        params.append(time() - idle)
+    with DBTransaction(opencatalog()) as [conn, cur]:
+        rows = [list(row) for row in cur.execute("SELECT code, created, lastactive, size FROM rooms" +
+                                                 (" WHERE " + " AND ".join(where) if len(where) > 0 else "") +
+                                                 " ORDER BY code", params)]
+        for row in rows:
+            row.append([str(x[0]) for x in cur.execute("SELECT username FROM owners WHERE room == ? ORDER BY rowid", (row[0],))])
+    return rows
+
+# recreate the catalog from the room databases; returns the number of rooms
+def rebuildcatalog():
+    rooms = sorted([f[:-len(".db")] for f in os.listdir(private + "rooms") if f.endswith(".db")])
+    rooms = [r for r in rooms if ROOM_RGX.match(r)]
+    with DBTransaction(opencatalog(), immediate=True) as [conn, cur]:
+        known = dict([(str(row[0]), row[1]) for row in cur.execute("SELECT code, created FROM rooms")])
+        cur.execute("DELETE FROM rooms")
+    for room in rooms:
+        ensureschema(roomdb(room))
+        if room not in getrooms(room):
+            continue
+        # the database files' mtimes are the best record of the last change
+        lastactive = roomdbmtime(room)
+        catalogroom(room, known.get(room, lastactive), lastactive)
+    return len(rooms)
+
+# bring the catalog in line with the room databases on disk: rooms that have
+# not committed anything since the catalog was created are added with their
+# files' mtime as lastactive, and rooms whose database is gone are dropped.
+# returns the numbers of rooms added and dropped
+def reconcilecatalog():
+    rooms = set([f[:-len(".db")] for f in os.listdir(private + "rooms") if f.endswith(".db")])
+    rooms = set([r for r in rooms if ROOM_RGX.match(r)])
+    with DBConnection(opencatalog()) as [conn, cur]:
+        known = set([str(row[0]) for row in cur.execute("SELECT code FROM rooms")])
+    added, dropped = 0, 0
+    for room in sorted(known - rooms):
+        if not os.path.exists(roomdb(room)):
+            uncatalogroom(room)
+            dropped += 1
+    for room in sorted(rooms - known):
+        ensureschema(roomdb(room))
+        if room not in getrooms(room):
+            continue
+        lastactive = roomdbmtime(room)
+        catalogroom(room, lastactive, lastactive)
+        added += 1
+    return added, dropped
+
+def roomdbmtime(room):
+    return max([os.path.getmtime(f) for f in [roomdb(room), roomdb(room) + "-wal"] if os.path.exists(f)] or [0])
+
+# delete a room that the catalog says has not changed since before. the check
+# is repeated while holding the room's write lock, and a room whose files were
+# written in the last CATALOG_TOUCH_INTERVAL seconds (which the catalog may
+# not show yet) is kept, so a room that comes back to life is never deleted.
+# returns whether the room was deleted.
+def expireroom(room, before):
+    room_db = roomdb(room)
+    if not ROOM_RGX.match(room):
+        raise Exception("expireroom: Room format incorrect: " + room)
+    if not os.path.exists(room_db):
+        uncatalogroom(room)
+        return False
+    with DBTransaction(room_db, immediate=True) as [conn, cur]:
+        with DBConnection(opencatalog()) as [cconn, ccur]:
+            row = list(ccur.execute("SELECT lastactive FROM rooms WHERE code == ?", (room,)))
+        if len(row) == 0 or row[0][0] >= before or time() - roomdbmtime(room) < CATALOG_TOUCH_INTERVAL:
+            return False
+        cur.execute("DELETE FROM rooms WHERE code == ?", (room,))
+    removeroomdb(room_db)
+    uncatalogroom(room)
+    return True
+
+# give the free pages of a database back to the file system; returns the
+# number of bytes saved. VACUUM holds the write lock while it runs, which
+# handlers wait out like any other writer. the database is opened read-write
+# without create, so a room removed meanwhile is skipped, not brought back empty.
+def compactdb(path):
+    if not os.path.exists(path):
+        return 0
+    before = sum([os.path.getsize(f) for f in [path, path + "-wal"] if os.path.exists(f)])
+    try:
+        conn = sqlite3.connect("file:" + path + "?mode=rw", uri=True, timeout=POOL_BUSY_TIMEOUT)
+    except sqlite3.OperationalError:
+        if os.path.exists(path):
+            raise
+        return 0
+    try:
+        conn.execute("VACUUM")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    finally:
+        conn.close()
+    return before - sum([os.path.getsize(f) for f in [path, path + "-wal"] if os.path.exists(f)])
+
+# the action log is a table in log.db, shared by all rooms and indexed by room,
+# user, action and time. each row holds one line of the old room.log format:
+# time,user,action,room[,args...], where args keeps the remaining fields as-is.
+LOG_DB = "log.db"
+LOG_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS log (id INTEGER PRIMARY KEY, time REAL NOT NULL, user TEXT NOT NULL, action TEXT NOT NULL, room TEXT NOT NULL, args TEXT)",
+    "CREATE INDEX IF NOT EXISTS log_room_time ON log (room, time)",
+    "CREATE INDEX IF NOT EXISTS log_room_user_action ON log (room, user, action, time)",
+]
+logchecked = set()
+
+def openlogdb(path=None):
+    if path is None:
+        path = private + LOG_DB
+    if path not in logchecked or not os.path.exists(path):
+        with DBConnection(path) as [conn, cur]:
+            for statement in LOG_SCHEMA + [x.format("stats_") for x in STATS_SCHEMA]:
+                cur.execute(statement)
+        logchecked.add(path)
+    return path
+
+def parselogline(data):
+    fields = data.split(",")
+    if len(fields) < 4:
+        raise Exception("parselogline: Malformed log line: " + data)
+    return (float(fields[0]), fields[1], fields[2], fields[3], ",".join(fields[4:]) if len(fields) > 4 else None)
+
+def formatlogrow(row):
+    # row is (time, user, action, room, args) and becomes a room.log line
+    return ",".join([repr(row[0]), row[1], row[2], row[3]] + ([row[4]] if row[4] is not None else []))
+
+def writelogrows(rows, path=None, stats=True):
+    with DBConnection(openlogdb(path)) as [conn, cur]:
+        cur.executemany("INSERT INTO log (time, user, action, room, args) VALUES (?, ?, ?, ?, ?)", rows)
+        if stats:
+            updatestats(cur, rows)
+
+# requests hand their log rows to a background thread, which commits whatever
+# has arrived every LOG_FLUSH_INTERVAL seconds in one transaction, so logging
+# never makes a request wait. if LOG_QUEUE_SIZE rows are already waiting, the
+# request writes them itself rather than dropping any. reads of the log in
+# this process flush first, so they always see this process's own writes.
+LOG_FLUSH_INTERVAL = 0.05
+LOG_QUEUE_SIZE = 4096
+
+class LogWriter:
+    def __init__(self):
+        self.lock = threading.Lock()        # guards pending and the thread
+        self.writing = threading.Lock()     # one batch is written at a time
+        self.wakeup = threading.Event()
+        self.pending = []                   # [path, row] in arrival order
+        self.pid = None
+    def start(self):
+        # a forked child does not inherit the parent's thread
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pending = []
+                thread = threading.Thread(target=self.run, name="queup-logwriter")
+                thread.daemon = True
+                thread.start()
+                self.pid = os.getpid()
+    def write(self, row):
+        if row[2] == "uadd" and row[0] > lastadd_cache.get((row[3], row[1]), 0):
+            lastadd_cache.set((row[3], row[1]), row[0])
+        if LOG_FLUSH_INTERVAL <= 0:
+            writelogrows([row])
+            return
+        self.start()
+        with self.lock:
+            self.pending.append([private + LOG_DB, row])
+            full = len(self.pending) >= LOG_QUEUE_SIZE
+        if full:
+            # the change being logged is already committed, so a failed write
+            # must not fail the request; the rows stay queued for the next try
+            try:
+                self.flush()
+            except Exception as e:
+                sys.stderr.write("queup log writer: " + str(e) + "\n")
+                sys.stderr.flush()
+        else:
+            self.wakeup.set()
+    def flush(self):
+        with self.writing:
+            with self.lock:
+                batch, self.pending = self.pending, []
+            paths = []
+            for entry in batch:
+                if entry[0] not in paths:
+                    paths.append(entry[0])
+            try:
+                for path in paths:
+                    writelogrows([entry[1] for entry in batch if entry[0] == path], path)
+            except:
+                # keep the rows for the next attempt
+                with self.lock:
+                    self.pending = batch + self.pending
+                raise
+    def run(self):
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            sleep(LOG_FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception as e:
+                sys.stderr.write("queup log writer: " + str(e) + "\n")
+                sys.stderr.flush()
+
+logwriter = LogWriter()
+atexit.register(logwriter.flush)
 
 def lockAndWriteLog(data):
-    global private
-    lock = acquireLock(private + "room.log")
-    with open(private + "room.log", "a+") as f:
-        f.write(data + "\n")
-    releaseLock(lock)
+    with metrics.timer("queup_phase_seconds", (("phase", "log"),)):
+        logwriter.write(parselogline(data))
+
+# where clause and parameters selecting the log rows of room (or every room)
+# between the before and after times, with one of the given actions and users
+def logfilter(room=None, before=None, after=None, actions=None, users=None):
+    where, params = [], []
+    if room is not None:
+        where.append("room == ?")
+        params.append(room)
+    if before is not None:
+        where.append("time < ?")
+        params.append(before)
+    if after is not None:
+        where.append("time > ?")
+        params.append(after)
+    for column, values in [("action", actions), ("user", users)]:
+        if values is not None and len(values) > 0:
+            where.append(column + " IN (" + ",".join(["?"] * len(values)) + ")")
+            params += list(values)
+    return where, params
+
+# log rows as lists of room.log fields, oldest first. with a limit, these are
+# the newest limit rows before before, or the oldest limit rows after after if
+# only after is given, so pages can be walked either way from a row's time.
+def getlog(room, limit=None, before=None, after=None, actions=None, users=None):
+    if limit is None:
+        return [formatlogrow(row).split(",") for row in iterlog(room, before, after, actions, users)]
+    logwriter.flush()
+    if not os.path.exists(private + LOG_DB):
+        return []
+    where, params = logfilter(room, before, after, actions, users)
+    order = "ASC" if after is not None and before is None else "DESC"
+    with DBConnection(openlogdb()) as [conn, cur]:
+        rows = list(cur.execute("SELECT time, user, action, room, args FROM log" +
+                                (" WHERE " + " AND ".join(where) if len(where) > 0 else "") +
+                                " ORDER BY time {0}, id {0} LIMIT ?".format(order), params + [limit]))
+    if order == "DESC":
+        rows.reverse()
+    return [formatlogrow(row).split(",") for row in rows]
+
+# log rows as (time, user, action, room, args), oldest first, read LOG_PAGE
+# rows at a time so that a long history is never held in memory (or a read
+# transaction held open) all at once
+LOG_PAGE = 1000
+
+def iterlog(room=None, before=None, after=None, actions=None, users=None):
+    logwriter.flush()
+    if not os.path.exists(private + LOG_DB):
+        return
+    where, params = logfilter(room, before, after, actions, users)
+    last = None
+    while True:
+        cursor, cursorparams = [], []
+        if last is not None:
+            cursor, cursorparams = ["(time > ? OR (time == ? AND id > ?))"], [last[0], last[0], last[1]]
+        with DBConnection(openlogdb()) as [conn, cur]:
+            rows = list(cur.execute("SELECT time, id, user, action, room, args FROM log" +
+                                    (" WHERE " + " AND ".join(where + cursor) if len(where + cursor) > 0 else "") +
+                                    " ORDER BY time, id LIMIT ?", params + cursorparams + [LOG_PAGE]))
+        for row in rows:
+            yield (row[0],) + tuple(row[2:])
+        if len(rows) < LOG_PAGE:
+            return
+        last = rows[-1][:2]
+
+# room.log compatibility: write the log (or one room's part of it) as room.log
+# lines to f, and read an existing room.log into the store. only lines older
+# than anything already stored are imported, so importing twice is harmless.
+def exportlog(f, room=None):
+    for row in iterlog(room):
+        f.write(formatlogrow(row) + "\n")
+
+# move the log rows older than before (of one room, or all of them) to a
+# gzipped room.log file in the archive directory, in the order they were
+# logged. the rows are read LOG_PAGE at a time by id without holding the write
+# lock, and the file is written and closed before any are deleted, a page's id
+# range per short transaction, so a failure leaves them in the store. rows
+# logged meanwhile get higher ids and are never in a range. returns the file
+# and the number of rows moved, or (None, 0) if there were none.
+def archivelog(before, room=None):
+    logwriter.flush()
+    if not os.path.isdir(private + "archive"):
+        try:
+            os.mkdir(private + "archive")
+        except OSError:
+            if not os.path.isdir(private + "archive"):
+                raise
+    path, fd = createarchive("log-" + (room + "-" if room is not None else "") + strftime("%Y%m%d-%H%M%S"))
+    where, params = logfilter(room, before)
+    pages = []      # the last id of each page written
+    n = 0
+    try:
+        raw = os.fdopen(fd, "wb")
+        try:
+            f = gzip.GzipFile(os.path.basename(path)[:-len(".gz")], "wb", 9, raw)
+            try:
+                while True:
+                    with DBConnection(openlogdb()) as [conn, cur]:
+                        rows = list(cur.execute("SELECT id, time, user, action, room, args FROM log WHERE " + " AND ".join(where + ["id > ?"]) +
+                                                " ORDER BY id LIMIT ?", params + [pages[-1] if len(pages) > 0 else -1, LOG_PAGE]))
+                    for row in rows:
+                        f.write((formatlogrow(row[1:]) + "\n").encode("utf-8"))
+                    n += len(rows)
+                    if len(rows) > 0:
+                        pages.append(rows[-1][0])
+                    if len(rows) < LOG_PAGE:
+                        break
+            finally:
+                f.close()
+            raw.flush()
+            os.fsync(raw.fileno())
+        finally:
+            raw.close()
+    except:
+        os.remove(path)
+        raise
+    if n == 0:
+        os.remove(path)
+        return None, 0
+    last = -1
+    for page in pages:
+        with DBTransaction(openlogdb(), immediate=True) as [conn, cur]:
+            cur.execute("DELETE FROM log WHERE " + " AND ".join(where + ["id > ?", "id <= ?"]), params + [last, page])
+        last = page
+    return path, n
+
+# create a new archive file named after name, never reusing an existing one
+# (two clears in the same second get name.gz and name-1.gz). returns its path
+# and an open file descriptor.
+def createarchive(name):
+    i = 0
+    while True:
+        path = private + "archive/" + name + ("-%d" % i if i > 0 else "") + ".gz"
+        try:
+            return path, os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            i += 1
+
+def importlog(f):
+    logwriter.flush()
+    with DBConnection(openlogdb()) as [conn, cur]:
+        first = list(cur.execute("SELECT min(time) FROM log"))[0][0]
+    rows = []
+    for line in f:
+        line = line.rstrip("\n")
+        if line == "":
+            continue
+        row = parselogline(line)
+        if first is None or row[0] < first:
+            rows.append(row)
+    # the rows predate everything in the store, so they cannot simply be
+    # added to the statistics; rebuildstats() takes them into account
+    writelogrows(rows, stats=False)
+    return len(rows)
+
+# queue statistics are kept up to date from the log as it is written, in the
+# same transaction as the log rows, so reading them never means reading the
+# log. for every room and queue they are:
+#   stats_waiting   who is in the queue now, since when, and when first marked
+#   stats_counts    arrivals and removals per STATS_INTERVAL seconds
+#   stats_waits     one row per finished wait: how long from uadd to being
+#                   removed (udel, usdel, qclr, ...) and to being marked
+# moving a user counts as a removal from one queue and an arrival in the
+# other, and their wait goes on in the new queue. "queupctl.py stats
+# --rebuild" recomputes everything from the log.
+STATS_INTERVAL = 3600
+STATS_WINDOW = 86400
+STATS_PERCENTILES = (50, 90, 99)
+STATS_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS {0}waiting (room TEXT NOT NULL, queue TEXT NOT NULL, user TEXT NOT NULL, since REAL NOT NULL, marked REAL, PRIMARY KEY (room, queue, user))",
+    "CREATE TABLE IF NOT EXISTS {0}counts (room TEXT NOT NULL, queue TEXT NOT NULL, start REAL NOT NULL, arrivals INTEGER NOT NULL DEFAULT 0, removals INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (room, queue, start))",
+    "CREATE TABLE IF NOT EXISTS {0}waits (room TEXT NOT NULL, queue TEXT NOT NULL, time REAL NOT NULL, wait REAL NOT NULL, tomark REAL)",
+    "CREATE INDEX IF NOT EXISTS {0}waits_room_queue_time ON {0}waits (room, queue, time)",
+]
+
+# the queue events in a log row (time, user, action, room, args), as tuples of
+# add/remove/mark (queue, user), move (queue, user, newqueue), clear (queue),
+# rename (queue, newqueue) or close ()
+def statsevents(row):
+    user, action = row[1], row[2]
+    args = row[4].split(",") if row[4] is not None else []
+    if action == "uadd" and len(args) >= 1:
+        return [("add", args[0], user)]
+    if action == "udel" and len(args) >= 1:
+        return [("remove", args[0], user)]
+    if action in ("usdel", "qmrk") and len(args) >= 2:
+        return [("remove" if action == "usdel" else "mark", args[0], args[1])]
+    if action == "umov" and len(args) >= 3:
+        return [("move", args[0], args[1], args[2])]
+    if action in ("qclr", "qdel") and len(args) >= 1:
+        return [("clear", args[0])]
+    if action == "qren" and len(args) >= 2:
+        return [("rename", args[0], args[1])]
+    if action in ("rdel", "rexpire"):
+        return [("close",)]
+    if action == "qbatch":
+        events = []
+        names = {"add": "add", "del": "remove", "mark": "mark", "move": "move", "clear": "clear"}
+        for op in args:
+            op = op.split(":")
+            if op[0] in names and len(op) == BATCH_ARGS[op[0]] + 1:
+                events.append(tuple([names[op[0]]] + op[1:]))
+        return events
+    return []
+
+def updatestats(cur, rows, prefix="stats_"):
+    def count(room, queue, t, column):
+        start = t - t % STATS_INTERVAL
+        cur.execute("INSERT OR IGNORE INTO {0}counts (room, queue, start) VALUES (?, ?, ?)".format(prefix), (room, queue, start))
+        cur.execute("UPDATE {0}counts SET {1} = {1} + 1 WHERE room == ? AND queue == ? AND start == ?".format(prefix, column), (room, queue, start))
+    def finish(room, queue, users, t):
+        where = "room == ? AND queue == ?" + (" AND user == ?" if users is not None else "")
+        params = (room, queue) + ((users,) if users is not None else ())
+        waiting = list(cur.execute("SELECT since, marked FROM {0}waiting WHERE {1}".format(prefix, where), params))
+        for since, marked in waiting:
+            cur.execute("INSERT INTO {0}waits (room, queue, time, wait, tomark) VALUES (?, ?, ?, ?, ?)".format(prefix),
+                        (room, queue, t, t - since, marked - since if marked is not None else None))
+            count(room, queue, t, "removals")
+        cur.execute("DELETE FROM {0}waiting WHERE {1}".format(prefix, where), params)
+    for row in rows:
+        t, room = row[0], row[3]
+        for event in statsevents(row):
+            if event[0] == "add":
+                cur.execute("INSERT OR REPLACE INTO {0}waiting (room, queue, user, since) VALUES (?, ?, ?, ?)".format(prefix),
+                            (room, event[1], event[2], t))
+                count(room, event[1], t, "arrivals")
+            elif event[0] == "remove":
+                finish(room, event[1], event[2], t)
+            elif event[0] == "mark":
+                # only the first mark counts towards the time to be marked
+                cur.execute("UPDATE {0}waiting SET marked = ? WHERE room == ? AND queue == ? AND user == ? AND marked IS NULL".format(prefix),
+                            (t, room, event[1], event[2]))
+            elif event[0] == "move":
+                cur.execute("UPDATE OR REPLACE {0}waiting SET queue = ? WHERE room == ? AND queue == ? AND user == ?".format(prefix),
+                            (event[3], room, event[1], event[2]))
+                if cur.rowcount > 0:
+                    count(room, event[1], t, "removals")
+                    count(room, event[3], t, "arrivals")
+            elif event[0] == "clear":
+                finish(room, event[1], None, t)
+            elif event[0] == "rename":
+                cur.execute("UPDATE OR REPLACE {0}waiting SET queue = ? WHERE room == ? AND queue == ?".format(prefix), (event[2], room, event[1]))
+            elif event[0] == "close":
+                cur.execute("DELETE FROM {0}waiting WHERE room == ?".format(prefix), (room,))
+
+# recompute the statistics from the whole log, e.g. after importing room.log.
+# the log as it was when the rebuild started is replayed in time order, a page
+# at a time, into scratch tables while it goes on being written; the rows
+# added since are replayed while holding the write lock, just before the
+# scratch tables replace the statistics. returns the number of rows replayed.
+def rebuildstats():
+    logwriter.flush()
+    path = openlogdb()
+    with DBConnection(path) as [conn, cur]:
+        for table in ["waiting", "counts", "waits"]:
+            cur.execute("DROP TABLE IF EXISTS rebuild_" + table)
+        for statement in STATS_SCHEMA:
+            cur.execute(statement.format("rebuild_"))
+        end = list(cur.execute("SELECT max(id) FROM log"))[0][0] or 0
+    last = None
+    n = 0
+    while True:
+        cursor, params = "", [end]
+        if last is not None:
+            cursor, params = " AND (time > ? OR (time == ? AND id > ?))", [end, last[0], last[0], last[1]]
+        with DBConnection(path) as [conn, cur]:
+            rows = list(cur.execute("SELECT time, id, user, action, room, args FROM log WHERE id <= ?" + cursor +
+                                    " ORDER BY time, id LIMIT ?", params + [LOG_PAGE]))
+            updatestats(cur, [(row[0],) + tuple(row[2:]) for row in rows], "rebuild_")
+        n += len(rows)
+        if len(rows) < LOG_PAGE:
+            break
+        last = rows[-1][:2]
+    with DBTransaction(path, immediate=True) as [conn, cur]:
+        rows = list(cur.execute("SELECT time, user, action, room, args FROM log WHERE id > ? ORDER BY id", (end,)))
+        updatestats(cur, rows, "rebuild_")
+        n += len(rows)
+        for table in ["waiting", "counts", "waits"]:
+            cur.execute("DELETE FROM stats_" + table)
+            cur.execute("INSERT INTO stats_{0} SELECT * FROM rebuild_{0}".format(table))
+            cur.execute("DROP TABLE rebuild_" + table)
+    return n
+
+# forget finished waits and counts from before a time
+def prunestats(before):
+    with DBConnection(openlogdb()) as [conn, cur]:
+        cur.execute("DELETE FROM stats_waits WHERE time < ?", (before,))
+        cur.execute("DELETE FROM stats_counts WHERE start < ?", (before - before % STATS_INTERVAL,))
+
+# the statistics of a room since a time (by default the last STATS_WINDOW
+# seconds), as {queue: {...}} for every queue with any activity, e.g.
+#   {"length": 3, "arrivals": 40, "removals": 37,
+#    "wait": {"n": 37, "p50": 310.5, "p90": 900.2, "p99": 1500.0},
+#    "tomark": {"n": 30, "p50": 250.1, ...},
+#    "intervals": [[start, arrivals, removals], ...]}
+def getstats(room, since=None):
+    logwriter.flush()
+    if since is None:
+        since = time() - STATS_WINDOW
+    stats = {}
+    def queue(name):
+        return stats.setdefault(name, {"length": 0, "arrivals": 0, "removals": 0, "intervals": []})
+    def percentiles(cur, q, column):
+        where = "room == ? AND queue == ? AND time >= ? AND {0} IS NOT NULL".format(column)
+        n = list(cur.execute("SELECT count(*) FROM stats_waits WHERE " + where, (room, q, since)))[0][0]
+        result = {"n": n}
+        for p in STATS_PERCENTILES:
+            result["p%d" % p] = None if n == 0 else list(cur.execute(
+                "SELECT {0} FROM stats_waits WHERE {1} ORDER BY {0} LIMIT 1 OFFSET ?".format(column, where),
+                (room, q, since, int(round(p / 100.0 * (n - 1))))))[0][0]
+        return result
+    with DBTransaction(openlogdb()) as [conn, cur]:
+        for name, length in cur.execute("SELECT queue, count(*) FROM stats_waiting WHERE room == ? GROUP BY queue", (room,)):
+            queue(str(name))["length"] = length
+        for name, start, arrivals, removals in cur.execute("SELECT queue, start, arrivals, removals FROM stats_counts "
+                                                           "WHERE room == ? AND start >= ? ORDER BY queue, start",
+                                                           (room, since - since % STATS_INTERVAL)):
+            q = queue(str(name))
+            q["arrivals"] += arrivals
+            q["removals"] += removals
+            q["intervals"].append([start, arrivals, removals])
+        for name in list(stats.keys()):
+            stats[name]["wait"] = percentiles(cur, name, "wait")
+            stats[name]["tomark"] = percentiles(cur, name, "tomark")
+    return stats
 
 class Lock:
     def __init__(self, lockdir):
@@ -397,104 +1726,640 @@ class Lock:
     def __exit__(self, type, value, traceback):
         releaseLock(self.lock)
 
-# implement a rate limiter class using the token bucket algo 
-# that takes the username, checks if they have an entry in 
-# ratelimit.db, and if so, checks if they have made more than 
-# 3 requests in the last second. if so, return false. otherwise, 
-# return true and update the database.
+# rate limiting uses a token bucket per key (a user or a room): a bucket holds
+# up to burst tokens, refills at rate tokens per second, and every request
+# takes one token. requests that find the bucket empty are limited.
+#
+# the buckets live in a small table in a shared memory-mapped file
+# (ratelimit.shm), so every Apache process sees the same counts without a
+# database write per request. a key hashes to RATELIMIT_PROBE consecutive
+# slots; buckets untouched for RATELIMIT_EXPIRE seconds are free for reuse,
+# and when none are the least recently used one is evicted. if the file cannot
+# be used, each process falls back to limiting on its own buckets.
+RATELIMIT_SHM = "ratelimit.shm"
+RATELIMIT_SLOTS = 8192
+RATELIMIT_PROBE = 8
+RATELIMIT_EXPIRE = 60
+#
+# each user has a bucket for all their requests, and each room one for the
+# students changing its queues (owners, chk, long-polls and sseupdate streams
+# only count against the user). the room bucket is sized for a whole lab
+# joining the queue at once when it starts. both are (rate, burst) and can be
+# set as "rate,burst" in the environment, as QUEUP_RATELIMIT_USER and
+# QUEUP_RATELIMIT_ROOM (e.g. in Apache's envvars file).
+def ratelimitsetting(name, default):
+    try:
+        rate, burst = [float(x) for x in os.environ[name].split(",")]
+    except (KeyError, ValueError):
+        return default
+    return (rate, burst)
+
+RATELIMIT_USER = ratelimitsetting("QUEUP_RATELIMIT_USER", (5, 5))       # 5 requests per second
+RATELIMIT_ROOM = ratelimitsetting("QUEUP_RATELIMIT_ROOM", (50, 500))    # 500 at once, then 50 per second
+RATELIMIT_SLOT = struct.Struct("<Qdd")   # key hash, tokens, last update
 
 class RateLimiter:
-    def __init__(self, dbpath):
-        self.dbpath = dbpath
-    def __enter__(self):
-        create = not os.path.exists(self.dbpath)
-        self.conn = sqlite3.connect(self.dbpath)
-        self.cur = self.conn.cursor()
-        if create:
-            with self.conn:
-                self.cur.execute("CREATE TABLE ratelimit (username TEXT KEY, time REAL)")
-        return [self, self.conn, self.cur]
-    def __exit__(self, type, value, traceback):
-        self.conn.commit()
-        self.conn.close()
-    def should_limit(self, username):
-        # get the last 5 requests
-        last5 = [x[0] for x in self.cur.execute("SELECT time FROM ratelimit WHERE username == (?) ORDER BY time DESC LIMIT 5", (username,))]
-        # if there are less than 5 requests, then we're good
-        if len(last5) < 5:
-            self.cur.execute("INSERT INTO ratelimit (username, time) VALUES (?, ?)", (username, time()))
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.pid = None
+        self.fd = None
+        self.map = None
+        self.local = {}         # fallback buckets: key hash -> [tokens, last]
+    def open(self):
+        # POSIX locks are per process, so a forked child opens the file anew
+        if self.pid == os.getpid():
+            return self.map is not None
+        self.pid = os.getpid()
+        self.fd = self.map = None
+        if fcntl is None or mmap is None:
             return False
-        # if the last request was more than a second ago, we're good
-        if time() - last5[-1] > 1:
-            self.cur.execute("INSERT INTO ratelimit (username, time) VALUES (?, ?)", (username, time()))
+        size = RATELIMIT_SLOTS * RATELIMIT_SLOT.size
+        try:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+            self.fd = fd
+        except (OSError, IOError, ValueError) as e:
+            sys.stderr.write("queup: rate limiting per process, cannot use %s: %s\n" % (self.path, str(e)))
+            sys.stderr.flush()
             return False
-        # otherwise, we're not good
         return True
+    def take(self, tokens, last, now, rate, burst):
+        tokens = min(float(burst), tokens + (now - last) * rate)
+        if tokens < 1:
+            return tokens, True
+        return tokens - 1, False
+    def should_limit(self, key, limit=RATELIMIT_USER):
+        rate, burst = limit
+        h = struct.unpack("<Q", hashlib.md5(key.encode("utf-8")).digest()[:8])[0] or 1
+        now = time()
+        with self.lock:
+            if not self.open():
+                bucket = self.local.get(h, [float(burst), now])
+                tokens, limited = self.take(bucket[0], bucket[1], now, rate, burst)
+                self.local[h] = [tokens, now]
+                if len(self.local) > RATELIMIT_SLOTS:
+                    self.local = dict([(k, v) for k, v in self.local.items() if now - v[1] < RATELIMIT_EXPIRE])
+                return limited
+            fcntl.lockf(self.fd, fcntl.LOCK_EX)
+            try:
+                start = h % RATELIMIT_SLOTS
+                found = None
+                free = None
+                oldest = None
+                for i in range(RATELIMIT_PROBE):
+                    offset = ((start + i) % RATELIMIT_SLOTS) * RATELIMIT_SLOT.size
+                    slot, tokens, last = RATELIMIT_SLOT.unpack_from(self.map, offset)
+                    if slot == h:
+                        found = (offset, tokens, last)
+                        break
+                    if free is None and (slot == 0 or now - last > RATELIMIT_EXPIRE):
+                        free = offset
+                    if oldest is None or last < oldest[1]:
+                        oldest = (offset, last)
+                if found is None:
+                    found = (free if free is not None else oldest[0], float(burst), now)
+                offset, tokens, last = found
+                tokens, limited = self.take(tokens, last, now, rate, burst)
+                RATELIMIT_SLOT.pack_into(self.map, offset, h, tokens, now)
+                return limited
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+ratelimiters = {}
+
+def getratelimiter(path):
+    limiter = ratelimiters.get(path, None)
+    if limiter is None:
+        limiter = ratelimiters.setdefault(path, RateLimiter(path))
+    return limiter
+
+# change notification for long-lived streams (sseupdate). each process runs one
+# hub per watched stream, e.g. one per room, however many clients subscribe to
+# it. the hub's thread notices commits to the database file, renders the
+# payload once, and every subscriber is handed the same string. each kind of
+# hub (RoomHub, LogHub) renders it in refresh, and since(lastid) returns what
+# to send a client that last saw the event with id lastid, as (id, data,
+# isdelta), with ids of its own that mean the same in every process.
+#
+# commits from other processes are detected with PRAGMA data_version, which
+# changes exactly when another connection commits to the file (including in
+# WAL mode, where inotify on the main file misses commits); commits made through
+# DBConnection/DBTransaction in this process wake the hub immediately.
+#
+# a change is only rendered once the database has been quiet for
+# HUB_COALESCE_WINDOW seconds (but at most HUB_COALESCE_MAX seconds after it
+# was noticed), so a burst of commits is pushed to clients as one update.
+HUB_POLL_INTERVAL = 0.1
+HUB_COALESCE_WINDOW = 0.05
+HUB_COALESCE_MAX = 0.25
+SSE_HEARTBEAT = 30
+
+class ChangeHub:
+    def __init__(self, key, path):
+        self.key = key
+        self.path = path
+        self.cond = threading.Condition()
+        self.wakeup = threading.Event()
+        self.subscribers = 0
+        self.listeners = []     # called with (seq, payload) on every new payload
+        self.running = False
+        self.seq = 0
+        self.payload = None
+    # subscribers either block in wait() or pass a listener, which is called
+    # from the hub's thread and must not block (see eventd.py)
+    def subscribe(self, listener=None):
+        with self.cond:
+            self.subscribers += 1
+            if listener is not None:
+                self.listeners.append(listener)
+            if self.running:
+                return
+            self.running = True
+        self.refresh()
+        thread = threading.Thread(target=self.run, name="queup-hub")
+        thread.daemon = True
+        thread.start()
+    def unsubscribe(self, listener=None):
+        with self.cond:
+            self.subscribers -= 1
+            if listener is not None:
+                self.listeners.remove(listener)
+    # must be called with cond held
+    def advance(self, payload):
+        self.payload = payload
+        self.seq += 1
+        self.cond.notify_all()
+        return self.seq
+    # block until there is a payload newer than seq, or timeout seconds pass.
+    # returns the latest (seq, payload); seq is unchanged on timeout.
+    def wait(self, seq, timeout):
+        with self.cond:
+            if self.seq == seq:
+                self.cond.wait(timeout)
+            return self.seq, self.payload
+    # wait for a burst of commits to end; returns the data_version it ended at
+    def settle(self, conn, version):
+        deadline = time() + HUB_COALESCE_MAX
+        while HUB_COALESCE_WINDOW > 0 and time() < deadline:
+            self.wakeup.wait(min(HUB_COALESCE_WINDOW, max(deadline - time(), 0)))
+            self.wakeup.clear()
+            latest = list(conn.execute("PRAGMA data_version"))[0][0]
+            if latest == version:
+                break
+            version = latest
+        return version
+    def run(self):
+        conn = None
+        inode = None
+        version = None
+        while True:
+            with self.cond:
+                if self.subscribers <= 0:
+                    self.running = False
+                    break
+            self.wakeup.wait(HUB_POLL_INTERVAL)
+            self.wakeup.clear()
+            try:
+                current = pool.inode(self.path)
+                if current != inode:
+                    # the file was created, removed or replaced
+                    if conn is not None:
+                        conn.close()
+                    conn = sqlite3.connect(self.path, check_same_thread=False) if current is not None else None
+                    inode = current
+                    version = None
+                latest = list(conn.execute("PRAGMA data_version"))[0][0] if conn is not None else None
+                if latest != version or latest is None:
+                    version = latest
+                    if conn is not None:
+                        version = self.settle(conn, version)
+                    self.refresh()
+            except Exception as e:
+                sys.stderr.write("queup hub %s: %s\n" % (str(self.key), str(e)))
+                sys.stderr.flush()
+        if conn is not None:
+            conn.close()
+        with hubslock:
+            if hubs.get(self.key, None) is self and not self.running:
+                del hubs[self.key]
+
+hubs = {}
+hubslock = threading.Lock()
+
+# the number of subscribers of every hub, as metrics gauges
+def hubgauges():
+    # summed by kind of stream (room, log), so the number of labels stays
+    # bounded and the metrics do not list room codes
+    with hubslock:
+        current = list(hubs.values())
+    counts = {}
+    for hub in current:
+        counts[hub.key[0]] = counts.get(hub.key[0], 0) + hub.subscribers
+    return [("queup_sse_subscribers", (("stream", kind),), counts[kind]) for kind in sorted(counts.keys())]
+
+def notifyhubs(path):
+    with hubslock:
+        for hub in hubs.values():
+            if hub.path == path:
+                hub.wakeup.set()
+
+# a room's hub also keeps the changes between its last few versions, so that
+# clients which opt in (sseupdate&delta=1) are sent only what changed instead
+# of the whole room. event ids are room versions; a client that reconnects
+# with a Last-Event-ID still in the history resumes with a single delta.
+HUB_DELTA_HISTORY = 64
+
+class RoomHub(ChangeHub):
+    def __init__(self, room, path):
+        ChangeHub.__init__(self, ("room", room), path)
+        self.room = room
+        self.state = None
+        self.version = None
+        self.deltas = []        # (from version, to version, ops), oldest first
+    def refresh(self):
+        try:
+            inode = pool.inode(self.path)
+            state = viewsnapshot(readroomsnapshot(self.path, self.room), False)
+        except Exception:
+            state = None
+        with self.cond:
+            if state is None:
+                # the room is gone; "{}" tells clients to leave
+                if self.payload == "{}":
+                    return
+                self.deltas = []
+                version = "deleted"
+            else:
+                version = str(state["version"])
+                if version == self.version:
+                    return
+                if self.state is None:
+                    self.deltas = []
+                else:
+                    self.deltas.append((self.version, version, diffstate(self.room, self.state, state)))
+                    self.deltas = self.deltas[-HUB_DELTA_HISTORY:]
+            self.state = state
+            self.version = version
+            payload = cachesnapshot(self.room, inode, state) if state is not None else "{}"
+            seq = self.advance(payload)
+            listeners = list(self.listeners)
+        for listener in listeners:
+            listener(seq, payload)
+    def since(self, lastid):
+        with self.cond:
+            ops = None
+            if lastid is not None and lastid != self.version:
+                for i in range(len(self.deltas)):
+                    if self.deltas[i][0] == lastid:
+                        ops = []
+                        for delta in self.deltas[i:]:
+                            ops.extend(delta[2])
+                        break
+            if ops is None:
+                return self.version, self.payload, False
+            return self.version, encodejson({"from": lastid, "to": self.version, "ops": ops}), True
+
+# the operations that turn one room state into another:
+#   ["set", key, value]      a room setting (subtitle, is-locked, cooldown, ...)
+#   ["qadd", queue]          an empty queue was created
+#   ["qdel", queue]          a queue and its members were deleted
+#   ["qren", old, new]       a queue was renamed, keeping its members
+#   ["join", queue, entry]   entry ([user, time, data, marked]) joined a queue
+#   ["leave", queue, user]   user left a queue
+#   ["mark", queue, user, m] user's mark was set to m
+def diffstate(room, old, new):
+    ops = []
+    for key in sorted(new.keys()):
+        if key != room and key != "version" and old.get(key, None) != new[key]:
+            ops.append(["set", key, new[key]])
+    oldqueues = dict(old[room])
+    newqueues = new[room]
+    removed = [q for q in oldqueues if q not in newqueues]
+    added = [q for q in newqueues if q not in oldqueues]
+    if len(removed) == 1 and len(added) == 1:
+        ops.append(["qren", removed[0], added[0]])
+        oldqueues[added[0]] = oldqueues.pop(removed[0])
+        removed, added = [], []
+    for q in sorted(removed):
+        ops.append(["qdel", q])
+    for q in sorted(added):
+        ops.append(["qadd", q])
+    for q in sorted(newqueues.keys()):
+        before = dict([(e[0], e) for e in oldqueues.get(q, [])])
+        after = dict([(e[0], e) for e in newqueues[q]])
+        for e in oldqueues.get(q, []):
+            if e[0] not in after or after[e[0]][:3] != e[:3]:
+                ops.append(["leave", q, e[0]])
+        for e in newqueues[q]:
+            if e[0] not in before or before[e[0]][:3] != e[:3]:
+                ops.append(["join", q, e])
+            elif before[e[0]][3] != e[3]:
+                ops.append(["mark", q, e[0], e[3]])
+    return ops
+
+def getroomhub(room, path):
+    with hubslock:
+        hub = hubs.get(("room", room), None)
+        if hub is None:
+            hub = RoomHub(room, path)
+            hubs[("room", room)] = hub
+        return hub
+
+# wait until the room's version is no longer version, or timeout seconds pass,
+# and return the version then ("deleted" if the room is gone). all the waiters
+# on a room share its hub, so they cost no queries while nothing changes.
+LONGPOLL_TIMEOUT = 25
+
+def waitversion(room, version, timeout):
+    hub = getroomhub(room, roomdb(room))
+    hub.subscribe()
+    try:
+        deadline = time() + timeout
+        while True:
+            with hub.cond:
+                current, seq = hub.version, hub.seq
+            if (current is not None and current != version) or time() >= deadline:
+                return current
+            hub.wait(seq, deadline - time())
+    finally:
+        hub.unsubscribe()
+
+# an admin log stream follows the log store instead of re-reading it: its hub
+# remembers the id of the newest row it has seen and on every change reads
+# only the rows of the room added since. the payload is the room's last
+# LOG_TAIL rows; event ids are log row ids, and the delta from one to another
+# is the list of rows added in between. rows logged a little out of order by
+# different processes are caught up to LOG_TAIL_SLACK seconds late. if the
+# newest row seen is gone (clearlog, or archived by queupctl.py maintain),
+# the tail is read again from scratch and clients are sent all of it.
+LOG_TAIL = 50
+LOG_TAIL_SLACK = 60
+
+class LogHub(ChangeHub):
+    def __init__(self, room):
+        ChangeHub.__init__(self, ("log", room), openlogdb())
+        self.room = room
+        self.rows = []          # [id, time, fields], oldest first
+        self.version = None
+        self.deltas = []        # (from id, to id, rows), oldest first
+    def refresh(self):
+        logwriter.flush()
+        with DBConnection(self.path) as [conn, cur]:
+            last = self.rows[-1] if len(self.rows) > 0 else None
+            if last is not None and list(cur.execute("SELECT room FROM log WHERE id == ?", (last[0],))) != [(self.room,)]:
+                last = None
+            if last is None:
+                rows = list(cur.execute("SELECT id, time, user, action, room, args FROM log WHERE room == ? "
+                                        "ORDER BY time DESC, id DESC LIMIT ?", (self.room, LOG_TAIL)))
+                rows.reverse()
+            else:
+                rows = list(cur.execute("SELECT id, time, user, action, room, args FROM log WHERE room == ? AND time >= ? "
+                                        "AND id > ? ORDER BY time, id", (self.room, last[1] - LOG_TAIL_SLACK, last[0])))
+        rows = [[row[0], row[1], formatlogrow(row[1:]).split(",")] for row in rows]
+        with self.cond:
+            if last is None:
+                self.rows = rows
+                self.deltas = []
+            elif len(rows) == 0:
+                return
+            else:
+                self.rows = (self.rows + rows)[-LOG_TAIL:]
+            version = str(self.rows[-1][0]) if len(self.rows) > 0 else "0"
+            if version == self.version and last is not None:
+                return
+            if last is not None:
+                self.deltas.append((self.version, version, [row[2] for row in rows]))
+                self.deltas = self.deltas[-HUB_DELTA_HISTORY:]
+            self.version = version
+            payload = encodejson([row[2] for row in self.rows])
+            if payload == self.payload:
+                return
+            seq = self.advance(payload)
+            listeners = list(self.listeners)
+        for listener in listeners:
+            listener(seq, payload)
+    def since(self, lastid):
+        with self.cond:
+            rows = None
+            if lastid is not None and lastid != self.version:
+                for i in range(len(self.deltas)):
+                    if self.deltas[i][0] == lastid:
+                        rows = []
+                        for delta in self.deltas[i:]:
+                            rows.extend(delta[2])
+                        break
+            if rows is None:
+                return self.version, self.payload, False
+            return self.version, encodejson(rows), True
+
+def getloghub(room):
+    with hubslock:
+        hub = hubs.get(("log", room), None)
+        if hub is None:
+            hub = LogHub(room)
+            hubs[("log", room)] = hub
+        return hub
+
+# back the room's log up to the archive directory and empty it
+def clearlog(room):
+    if not ROOM_RGX.match(room):
+        raise Exception("clearlog: Room format incorrect: " + room)
+    return archivelog(time(), room)
+
+# serve a hub's payloads as server-sent events until the client goes away.
+# a comment line is sent every SSE_HEARTBEAT seconds without changes, which
+# also notices disconnected clients. with deltas, clients are sent "delta"
+# events where the hub has them; lastid is the Last-Event-ID of a client
+# resuming a stream, which is sent nothing until the next change.
+def streamhub(req, hub, until=None, deltas=False, lastid=None):
+    hub.subscribe()
+    try:
+        seq = None
+        while True:
+            latest, payload = hub.wait(seq, SSE_HEARTBEAT)
+            try:
+                if latest == seq:
+                    req.write(": heartbeat\n\n")
+                else:
+                    eventid, data, isdelta = hub.since(lastid if deltas else None)
+                    if eventid is None:
+                        req.write("data: %s\n\r" % data)
+                    elif eventid != lastid:
+                        req.write("id: %s\n%sdata: %s\n\r" % (eventid, "event: delta\n" if isdelta else "", data))
+                    lastid = eventid
+            except:
+                return
+            seq = latest
+            if until is not None and payload == until:
+                return
+    finally:
+        hub.unsubscribe()
 
 ######################
 # Main application.
 ######################
+# the mod_python entry point
 def handler(req):
-    global ip, room_db, private
-    class EventHandler(pyinotify.ProcessEvent):
-        def __init__(self, roomname):
-            self.roomname = roomname
-        def process_IN_MODIFY(self, event):
-            try:
-                req.write("data: %s\n\r" % json.dumps(getusers("", self.roomname)))
-            except:
-                pass
-    
+    global private
     # grab config based on IP and init all variables
-    if 'HOME' not in os.environ:
-        os.environ['HOME'] = '/var/www/html'
-    try:
-        private = os.environ['DOCUMENT_ROOT'].replace("~", "") + os.environ['CONTEXT_PREFIX'].replace("~", "") + '/private/queup/'
-    except KeyError:
-        # os.environ['DOCUMENT_ROOT'] is not set by CGI resulting in a exception
-        # so we are being invoked by mod_python, so we need different env vars
-        private = os.environ['HOME'] + '/private/queup/'
-    
+    if private == "":
+        if 'HOME' not in os.environ:
+            os.environ['HOME'] = '/var/www/html'
+        try:
+            private = os.environ['DOCUMENT_ROOT'].replace("~", "") + os.environ['CONTEXT_PREFIX'].replace("~", "") + '/private/queup/'
+        except KeyError:
+            # os.environ['DOCUMENT_ROOT'] is not set by CGI resulting in a exception
+            # so we are being invoked by mod_python, so we need different env vars
+            private = os.environ['HOME'] + '/private/queup/'
+    status = dispatch(req, lambda: util.FieldStorage(req))
+    if status == apache.HTTP_NOT_MODIFIED:
+        # returned as is, Apache would answer with an error page and without
+        # the ETag header; a 304 is a response like any other
+        req.status = status
+        return apache.OK
+    return status
+
+# a query value as text. mod_python hands out byte strings on Python 2, while
+# wsgi.py and Python 3 hand out text.
+def getfield(query, name, default=''):
+    value = query.get(name, default)
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    return value
+
+# serve one request. req is a mod_python request or anything with the same
+# attributes (see wsgi.py); getquery parses its query into a mapping of field
+# values, which is only done once the user has passed the rate limiter.
+def dispatch(req, getquery):
+    parsed = []
+    def query():
+        parsed.append(getquery())
+        return parsed[-1]
+    start = time()
+    status = serve(req, query)
+    kind = requestkind(parsed[-1]) if len(parsed) > 0 else "rejected"
+    if kind != "sseupdate":
+        metrics.observe("queup_request_seconds", time() - start, (("kind", kind),))
+    metrics.count("queup_requests_total", (("kind", kind), ("status", str(200 if status == apache.OK else status))))
+    return status
+
+ACTIONS = ['add', 'del', 'chk', 'ren', 'own', 'delown', 'setcool', 'setsub', 'lock', 'unlock', 'clear', 'mark', 'batch', 'move']
+
+# how requests are told apart in the metrics, e.g. room_chk, queue_mark,
+# user_add. only known actions get a kind of their own, so that requests
+# cannot make up new labels.
+def requestkind(query):
+    for kind in ["sseupdate", "metrics"]:
+        if kind in query:
+            return kind
+    action = getfield(query, 'action')
+    if action not in ACTIONS:
+        return "invalid"
+    if action == 'chk' and 'since' in query:
+        action = 'poll'
+    if getfield(query, 'setup') == '':
+        return "user_" + action
+    return ("queue_" if 'queue' in query else "room_") + action
+
+def dumps(obj):
+    with metrics.timer("queup_phase_seconds", (("phase", "json"),)):
+        return encodejson(obj)
+
+# what a chk response depends on besides the room's version. the inode of the
+# room's database tells a room apart from an earlier one with the same code,
+# whose versions counted up from the same start
+def roometag(room, inode, version, is_owner):
+    return '"%s.%s-%s%s"' % (inode[1], version, "o" if is_owner else "v", "p" if getroompermanency(room) else "")
+
+# answer a chk with the room's snapshot, tagged with its inode and version. a
+# client that sends back the tag it has (If-None-Match) is answered 304 Not
+# Modified without the room being read; one that passes since=<inode>.<version>
+# (the start of the tag) is held until the room differs from that, for up to
+# LONGPOLL_TIMEOUT seconds, and is answered 304 if it never does. a since
+# without an inode is held the same way but always answered with the room, as
+# it may be from an earlier room. "{}" means the room is gone. version is the
+# room's version read at the start of the request, if any.
+def chkroom(req, query, room, is_owner, version=None):
+    since = getfield(query, 'since')
+    req.headers_out['Cache-Control'] = 'no-cache'
+    inode = pool.inode(roomdb(room))
+    if since != '':
+        tag = since.split(".")
+        if len(tag) > 2 or not all([x.isdigit() for x in tag]):
+            return apache.HTTP_BAD_REQUEST
+        if len(tag) == 1 or inode is not None and tag[0] == str(inode[1]):
+            waitversion(room, tag[-1], LONGPOLL_TIMEOUT)
+            inode = pool.inode(roomdb(room))
+            version = None
+    if version is None:
+        version = getroomversion(room)
+    if inode is None or version is None:
+        req.write("{}")
+        return apache.OK
+    etag = roometag(room, inode, version, is_owner)
+    if since == "%s.%s" % (inode[1], version) or req.headers_in.get('If-None-Match', None) == etag:
+        req.headers_out['ETag'] = etag
+        return apache.HTTP_NOT_MODIFIED
+    version, data = getroomjson(room, is_owner, version)
+    req.headers_out['ETag'] = roometag(room, inode, version, is_owner)
+    req.write(data)
+    return apache.OK
+
+def serve(req, getquery):
     # initialize some variables
     user = req.user
-    if user == "":
+    if user == "" or user is None:
         return apache.HTTP_UNAUTHORIZED
     
     # check rate limit for this user
-    with RateLimiter(private + "ratelimit.db") as [rl, conn, cur]:
-        if rl.should_limit(user):
-            return apache.HTTP_PRECONDITION_FAILED   # why I can't do IM_A_TEAPOT or TOO_MANY_REQUESTS is beyond science
+    ratelimiter = getratelimiter(private + RATELIMIT_SHM)
+    with metrics.timer("queup_phase_seconds", (("phase", "ratelimit"),)):
+        limited = ratelimiter.should_limit("user:" + user, RATELIMIT_USER)
+    if limited:
+        return apache.HTTP_PRECONDITION_FAILED   # why I can't do IM_A_TEAPOT or TOO_MANY_REQUESTS is beyond science
     
-    query = util.FieldStorage(req)
+    query = getquery()
     ip = req.useragent_ip
     
-    room = query.get('room', '').decode('utf-8')
-    if len(room) != 5 or not re.search(r"[A-Z0-9]{5}", room):
+    # this process's metrics, for the users in metrics_users
+    if 'metrics' in query:
+        if user not in readlistfile(METRICS_USERS):
+            return apache.HTTP_UNAUTHORIZED
+        req.content_type = "text/plain; version=0.0.4; charset=utf-8"
+        req.send_http_header()
+        req.write(metrics.render(hubgauges()))
+        return apache.OK
+    
+    room = getfield(query, 'room')
+    if not ROOM_RGX.match(room):
         req.log_error("Invalid room name: " + room + "\n")
         return apache.HTTP_BAD_REQUEST 
-    action = query.get('action', '').decode('utf-8')
-    actions = ['add', 'del', 'chk', 'ren', 'own', 'delown', 'setcool', 'setsub', 'lock', 'unlock', 'clear', 'mark']
-    if 'sseupdate' not in query and not (action in actions):
+    action = getfield(query, 'action')
+    if 'sseupdate' not in query and not (action in ACTIONS):
         req.log_error("Invalid action: " + action + "\n")
         return apache.HTTP_BAD_REQUEST
-    setup = query.get('setup', '').decode('utf-8')
+    setup = getfield(query, 'setup')
     roomsetup = (setup != '') and (action != '') and (room != '') and 'queue' not in query
     queuesetup = (setup != '') and (action != '') and (room != '') and 'queue' in query
     querychecked = setup == '' and (action != '') and (room != '') and 'queue' in query
 
     # do we have a room to access? then we must be either its owner or we must 
     # be chk, sseupdate, or adding/deleting ourselves from a queue (no setup)
-    room_db = private + "rooms/" + room + ".db"
+    room_db = roomdb(room)
     
     # is user owner? set to true if room doesn't exist, must be owner to create room
+    version = None
     if os.path.exists(room_db):
-        try:
-            is_owner = user in getowners(room)
-        except sqlite3.OperationalError as e:
-            if "no such table" in str(e):
-                # file exists but table does not, seems like a mistake.
-                # remove it and recreate.
-                os.remove(room_db)
+        # converts a room created before the normalized schema on first use
+        ensureschema(room_db)
+        # the cached settings, directory and snapshot are checked against
+        # this until the request changes the room
+        version = getroomversion(room)
+        with metrics.timer("queup_phase_seconds", (("phase", "owners"),)):
+            is_owner = user in getowners(room, version)
         conditions_for_access_nodb = [
             action in ['chk'],
             'sseupdate' in query,
@@ -512,26 +2377,34 @@ def handler(req):
         req.log_error("Malformed request while setting is_owner. Query was %s\r\n" % query)
         return apache.HTTP_BAD_REQUEST
     
-    newusers = query.get('newusers', '').decode('utf-8').strip()
-    subtitle = query.get('subtitle', '').decode('utf-8').strip()
+    # the room bucket only holds back students changing the queues
+    if not is_owner and action != 'chk' and 'sseupdate' not in query:
+        if ratelimiter.should_limit("room:" + room, RATELIMIT_ROOM):
+            return apache.HTTP_PRECONDITION_FAILED
+    
+    newusers = getfield(query, 'newusers').strip()
+    subtitle = getfield(query, 'subtitle').strip()
     
     # now check our variables
-    rooms = getrooms()
+    with metrics.timer("queup_phase_seconds", (("phase", "directory"),)):
+        directory = getdirectory(room, version)
+    rooms = directory.rooms
     
     # this section handles adding and removing in a room
     if roomsetup:
         # check actions based on whether adding/deleting
         will_add     = action == 'add'  # room should not be in the database already
-        will_del     = action == 'del' and "room"+room in rooms # room was in the database
-        will_chk     = action == 'chk' and "room"+room in rooms # room was in the database
-        will_own     = action == 'own' and "room"+room in rooms # room was in the database
-        will_own     = will_own and (newusers == "" or all([re.match(USER_RGX, x) for x in newusers.split(",")]))
-        will_delown  = action == 'delown' and "room"+room in rooms # room was in the database
-        will_delown  = will_delown and (newusers == "" or all([re.match(USER_RGX, x) for x in newusers.split(",")]))
-        will_setsub  = action == 'setsub' and "room"+room in rooms # room was in the database
-        will_setsub  = will_setsub and (subtitle == "" or re.match(SUBTITLE_RGX, subtitle))
-        will_tgllock = action in ['lock', 'unlock'] and "room"+room in rooms # room was in the database
-        will_setcool = action == 'setcool' and "room"+room in rooms # room was in the database
+        will_del     = action == 'del' and room in rooms # room was in the database
+        will_chk     = action == 'chk' and room in rooms # room was in the database
+        will_own     = action == 'own' and room in rooms # room was in the database
+        will_own     = will_own and (newusers == "" or all([USER_RGX.match(x) for x in newusers.split(",")]))
+        will_delown  = action == 'delown' and room in rooms # room was in the database
+        will_delown  = will_delown and (newusers == "" or all([USER_RGX.match(x) for x in newusers.split(",")]))
+        will_setsub  = action == 'setsub' and room in rooms # room was in the database
+        will_setsub  = will_setsub and (subtitle == "" or SUBTITLE_RGX.match(subtitle))
+        will_tgllock = action in ['lock', 'unlock'] and room in rooms # room was in the database
+        will_setcool = action == 'setcool' and room in rooms # room was in the database
+        will_batch   = action == 'batch' and room in rooms # room was in the database
         # perform the action
         if will_add:
             try:
@@ -540,61 +2413,47 @@ def handler(req):
                 req.log_error("Error creating room %s by owner %s from %s\r\n" % (room, user, ip))
                 req.write(str(e))
                 return apache.OK
-            rooms = getrooms()
-            userdata = getusers("", room)
-            userdata["is-owner"] = is_owner
-            userdata["cooldown"] = getcooldown(room)
-            if is_owner:
-                userdata["owners"] = getowners(room)
+            # it is possible to define a room first before creating it, so the
+            # snapshot checks permanency anyway
+            userdata = viewsnapshot(getroomsnapshot(room), is_owner)
             userdata["subtitle"] = ""
-            userdata["is-locked"] = False
-            # it is possible to define a room first before creating it, so check permanency anyway
-            userdata["is-permanent"] = getroompermanency(room)
             lockAndWriteLog(",".join([str(time()), user, "rcreate", room]))
-            req.write(json.dumps(userdata))
+            req.write(dumps(userdata))
             return apache.OK
         elif will_chk:
-            if "room"+room not in rooms:
+            if room not in rooms:
                 req.log_error("Room %s not found in database. May be misconfigured." % room)
                 return apache.HTTP_BAD_REQUEST
-            userdata = getusers("", room)
-            userdata["is-owner"] = is_owner
-            userdata["cooldown"] = getcooldown(room)
-            if is_owner:
-                userdata["owners"] = getowners(room)
-            userdata["subtitle"] = getroomsubtitle(room)
-            userdata["is-locked"] = isroomlocked(room)
-            userdata["is-permanent"] = getroompermanency(room)
-            if "admin" not in query or not is_owner:
+            # conditional and long-poll checks refresh a room already entered
+            if ("admin" not in query or not is_owner) and 'since' not in query and req.headers_in.get('If-None-Match', None) is None:
                 lockAndWriteLog(",".join([str(time()), user, "rchk", room]))
-            req.write(json.dumps(userdata))
-            return apache.OK
+            return chkroom(req, query, room, is_owner, version)
         else:
             if not is_owner:
                 req.log_error("roomsetup: User %s is not an owner of room %s. Query was %s\r\n" % (user, room, query))
                 return apache.HTTP_UNAUTHORIZED
             try:
                 if will_del:
-                    if room in open(private + "nodel_rooms").read():
+                    if getroompermanency(room):
                         return apache.HTTP_BAD_REQUEST
                     deleteroom(room)
                     lockAndWriteLog(",".join([str(time()), user, "rdel", room]))
-                    req.write(json.dumps({"status": "success"}))
+                    req.write(dumps({"status": "success"}))
                     return apache.OK
                 elif will_own:
                     ownroom(room, newusers)
                     lockAndWriteLog(",".join([str(time()), user, "rown", room, newusers]))
-                    req.write(json.dumps(getowners(room)))
+                    req.write(dumps(getowners(room)))
                     return apache.OK
                 elif will_delown:
                     delownroom(room, newusers)
                     lockAndWriteLog(",".join([str(time()), user, "rdelown", room, newusers]))
-                    req.write(json.dumps(getowners(room)))
+                    req.write(dumps(getowners(room)))
                     return apache.OK
                 elif will_setsub:
                     setroomsubtitle(room, subtitle)
                     lockAndWriteLog(",".join([str(time()), user, "rsub", room, subtitle]))
-                    req.write(json.dumps({"status": "success"}))
+                    req.write(dumps({"status": "success"}))
                     return apache.OK
                 elif will_tgllock:
                     if action == 'unlock':
@@ -603,13 +2462,28 @@ def handler(req):
                     else:
                         lockroom(room)
                         lockAndWriteLog(",".join([str(time()), user, "rlock", room]))
-                    req.write(json.dumps({"status": "success"}))
+                    req.write(dumps({"status": "success"}))
+                    return apache.OK
+                elif will_batch:
+                    try:
+                        ops = parsebatch(getfield(query, 'ops'), directory.queues)
+                    except Exception as e:
+                        req.log_error("Invalid batch on room %s by owner %s from %s: %s\r\n" % (room, user, ip, str(e)))
+                        return apache.HTTP_BAD_REQUEST
+                    try:
+                        runbatch(ops, room)
+                    except sqlite3.IntegrityError:
+                        req.log_error("Batch on room %s by owner %s would add a user to a queue twice\r\n" % (room, user))
+                        return apache.HTTP_BAD_REQUEST
+                    # one log record for the whole batch, e.g. mark:q:user,move:q:user:newq
+                    lockAndWriteLog(",".join([str(time()), user, "qbatch", room] + [":".join(op) for op in ops]))
+                    req.write(getroomjson(room, is_owner)[1])
                     return apache.OK
                 elif will_setcool:
-                    cooldown = int(query.get('cooldown', '').decode('utf-8'))
+                    cooldown = int(getfield(query, 'cooldown'))
                     setcooldown(cooldown, room)
                     lockAndWriteLog(",".join([str(time()), user, "rcool", room, str(cooldown)]))
-                    req.write(json.dumps({"status": "success"}))
+                    req.write(dumps({"status": "success"}))
                     return apache.OK
                 else:
                     req.log_error("No valid query " + str(query) + "\n")
@@ -624,32 +2498,35 @@ def handler(req):
         if not is_owner:
             req.log_error("queuesetup: User %s is not an owner of room %s. Query was %s\r\n" % (user, room, query))
             return apache.HTTP_UNAUTHORIZED
-        room = query.get('room', '').encode('ascii').strip()
-        queue = query.get('queue', '').encode('ascii').strip()
-        if len(room) != 5 or not re.search(ROOM_RGX, room):
+        room = getfield(query, 'room').strip()
+        queue = getfield(query, 'queue').strip()
+        if len(room) != 5 or not ROOM_RGX.search(room):
             req.log_error("InvalidRoomError: running action %s on room %s by owner %s from %s. Query was %s\r\n" % (action, room, user, ip, query))
             return apache.HTTP_BAD_REQUEST
-        if not re.search(QUEUE_RGX, queue):
+        if not QUEUE_RGX.search(queue):
             req.log_error("InvalidQueueError: running action %s on room %s by owner %s from %s. Query was %s\r\n" % (action, room, user, ip, query))
             return apache.HTTP_BAD_REQUEST
-        queue = query.get('queue', '').encode('ascii').strip()
-        newqueue = query.get('newqueue', '').decode('utf-8').strip()
-        username = query.get('username', '').decode('utf-8').strip()
+        queue = getfield(query, 'queue').strip()
+        newqueue = getfield(query, 'newqueue').strip()
+        username = getfield(query, 'username').strip()
         # check actions based on whether adding/deleting/checking/renaming
-        will_add = query.get('action', None).decode('utf-8').strip() == 'add'
-        will_del = query.get('action', None).decode('utf-8').strip() == 'del' and "room"+room in rooms # room was in the database
-        will_del = will_del and queue in getqueues(room) # queue was in the database
-        will_chk = query.get('action', None).decode('utf-8').strip() == 'chk' and "room"+room in rooms # room was in the database
-        will_chk = will_chk and queue in getqueues(room) # queue was in the database
-        will_ren = query.get('action', None).decode('utf-8').strip() == 'ren' and "room"+room in rooms # room was in the database
-        will_ren = will_ren and queue in getqueues(room) # queue was in the database
-        will_ren = will_ren and re.match(QUEUE_RGX, newqueue) and newqueue not in getqueues(room) # new queue must not already exist and newqueue != ''
-        will_clear = query.get('action', None).decode('utf-8').strip() == 'clear' and "room"+room in rooms # room was in the database
-        will_clear = will_clear and queue in getqueues(room) # queue was in the database
-        will_mark = query.get('action', None).decode('utf-8').strip() == 'mark' and "room"+room in rooms # room was in the database
-        will_mark = will_mark and queue in getqueues(room) and any([username == x[0] for x in getusers(queue, room)])   # queue was in the database and user is in the queue
+        will_add = getfield(query, 'action').strip() == 'add'
+        will_del = getfield(query, 'action').strip() == 'del' and room in rooms # room was in the database
+        will_del = will_del and queue in directory.queues # queue was in the database
+        will_chk = getfield(query, 'action').strip() == 'chk' and room in rooms # room was in the database
+        will_chk = will_chk and queue in directory.queues # queue was in the database
+        will_ren = getfield(query, 'action').strip() == 'ren' and room in rooms # room was in the database
+        will_ren = will_ren and queue in directory.queues # queue was in the database
+        will_ren = will_ren and QUEUE_RGX.match(newqueue) and newqueue not in directory.queues # new queue must not already exist and newqueue != ''
+        will_clear = getfield(query, 'action').strip() == 'clear' and room in rooms # room was in the database
+        will_clear = will_clear and queue in directory.queues # queue was in the database
+        will_mark = getfield(query, 'action').strip() == 'mark' and room in rooms # room was in the database
+        will_mark = will_mark and queue in directory.queues and isinqueue(username, queue, room)   # queue was in the database and user is in the queue
+        will_move = getfield(query, 'action').strip() == 'move' and room in rooms # room was in the database
+        will_move = will_move and queue in directory.queues and newqueue in directory.queues and newqueue != queue # both queues were in the database
+        will_move = will_move and isinqueue(username, queue, room) # user is in the queue they are moved from
         # perform the action
-        if will_add or will_del or will_ren or will_clear or will_mark:
+        if will_add or will_del or will_ren or will_clear or will_mark or will_move:
             try:
                 if will_add:
                     try:
@@ -658,10 +2535,10 @@ def handler(req):
                         if "already exists" in str(e):
                             pass
                     lockAndWriteLog(",".join([str(time()), user, "qadd", room, queue]))
-                    req.write(json.dumps(getusers("", room)))
+                    req.write(getroomjson(room, is_owner)[1])
                 elif will_del:
                     # queue cannot be the only queue in the room!
-                    if len(getqueues(room)) == 1:
+                    if len(directory.queues) == 1:
                         req.log_error("Cannot delete the only queue in a room. Query was %s\r\n" % query)
                         return apache.HTTP_BAD_REQUEST
                     deletequeue(queue, room)
@@ -669,18 +2546,27 @@ def handler(req):
                 elif will_ren:
                     renamequeue(queue, newqueue, room)
                     lockAndWriteLog(",".join([str(time()), user, "qren", room, queue, newqueue]))
-                    req.write(json.dumps(getusers("", room)))
+                    req.write(getroomjson(room, is_owner)[1])
                 elif will_clear:
-                    # get all users and remove them from the queue
-                    for u in getusers(queue, room):
-                        delquser(u[0], queue, room)
+                    # remove all users from the queue at once
+                    clearqueue(queue, room)
                     lockAndWriteLog(",".join([str(time()), user, "qclr", room, queue]))
-                    req.write(json.dumps(getusers("", room)))
+                    req.write(getroomjson(room, is_owner)[1])
                 elif will_mark:
                     # toggle mark on user
                     togglemark(username, queue, room)
                     lockAndWriteLog(",".join([str(time()), user, "qmrk", room, queue, username]))
-                    req.write(json.dumps(getusers("", room)))
+                    req.write(getroomjson(room, is_owner)[1])
+                elif will_move:
+                    # the user keeps their place in line unless keeptime=0
+                    keeptime = getfield(query, 'keeptime', '1').strip() != '0'
+                    try:
+                        moveuser(username, queue, newqueue, room, keeptime)
+                    except sqlite3.IntegrityError:
+                        req.log_error("User %s is already in queue %s in room %s\r\n" % (username, newqueue, room))
+                        return apache.HTTP_BAD_REQUEST
+                    lockAndWriteLog(",".join([str(time()), user, "umov", room, queue, username, newqueue]))
+                    req.write(getroomjson(room, is_owner)[1])
                 else:
                     req.log_error("No valid under queuesetup query " + str(query) + "\n")
                     return apache.HTTP_BAD_REQUEST
@@ -693,29 +2579,26 @@ def handler(req):
                 req.log_error(str(e))
                 return apache.OK
         elif will_chk:
-            req.write(json.dumps(getusers("", room)))
-            return apache.OK
+            return chkroom(req, query, room, is_owner, version)
         else:
-            sys.stderr.write("Invalid action: " + str(query.get('action', None).decode('utf-8').strip()) + "\n")
+            sys.stderr.write("Invalid action: " + str(getfield(query, 'action').strip()) + "\n")
             sys.stderr.write("query string: " + str(query) + "\n")
             sys.stderr.flush()
             return apache.HTTP_BAD_REQUEST
     elif querychecked:
-        room = query.get('room', '').encode('ascii').strip()
-        queue = query.get('queue', '').encode('ascii').strip()
-        username = query.get('username', '').encode('ascii').strip()
-        if room == '' or "room"+room not in rooms or queue == '' or queue not in getqueues(room):
-            sys.stderr.write("Invalid room/queue name: " + str(room) + "/" + str(queue) + "," + str(rooms) + "," + str(getqueues(room)) + "\n")
+        room = getfield(query, 'room').strip()
+        queue = getfield(query, 'queue').strip()
+        username = getfield(query, 'username').strip()
+        if room == '' or room not in rooms or queue == '' or queue not in directory.queues:
+            sys.stderr.write("Invalid room/queue name: " + str(room) + "/" + str(queue) + "," + str(sorted(rooms)) + "," + str(directory.names) + "\n")
             sys.stderr.flush()
             return apache.HTTP_BAD_REQUEST
-        # room name should already be in database
-        db_queue = getusers(queue, room)
         # check if room is locked before adding anyone unless we are owner
         # perform actions based on whether adding/deleting (will_del does not include owner deleting users)
-        will_add = action == 'add' and not any([user == x[0] for x in db_queue]) # username should not be in the room already
-        will_del = action == 'del' and any([user == x[0] for x in db_queue]) and (username == '') # username was in the room and is not someone else or empty
-        staff_del = is_owner and action == 'del' and username is not None and any([username == x[0] for x in db_queue]) # username was in the room
-        if isroomlocked(room) and not is_owner and will_add:
+        will_add = action == 'add' # the entries table rejects a username already in the queue
+        will_del = action == 'del' and (username == '') and isinqueue(user, queue, room) # username was in the room and is not someone else or empty
+        staff_del = is_owner and action == 'del' and username != '' and isinqueue(username, queue, room) # username was in the room
+        if isroomlocked(room, version) and not is_owner and will_add:
             req.log_error("Room %s is locked. Query was %s\r\n" % (room, query))
             return apache.HTTP_LOCKED
         # only make changes to database if changes are to be made
@@ -723,20 +2606,24 @@ def handler(req):
             if will_add:
                 # check if there is a cooldown period, and that user is not adding themselves more than
                 # COOLDOWN minutes since their last add
-                cooldown = getcooldown(room)
+                cooldown = getcooldown(room, version)
                 if cooldown > 0:
-                    lastadd = getlastadd(room, user)
+                    lastadd = getlastadd(room, user, cooldown * 60)
                     if (time() - lastadd) < (cooldown * 60):
                         rem_min = int(cooldown - (time() - lastadd) / 60)
                         rem_sec = int((cooldown - (time() - lastadd) / 60) % 1 * 60)
                         req.log_error("User %s is adding themselves to room %s too often. %sm, %ss remaining" % (user, room, str(rem_min), str(rem_sec)))
                         req.write("[cooldown] This room only permits you to add yourself to any queue every %d minutes. Please wait %d minutes and %s seconds before adding yourself again.\n" % (cooldown, rem_min, rem_sec))
                         return apache.OK        # caught by JS
-                waitdata = query.get('waitdata', '').encode('ascii').strip()
-                if waitdata != '' and not re.match(WAITDATA_RGX, waitdata):
+                waitdata = getfield(query, 'waitdata').strip()
+                if waitdata != '' and not WAITDATA_RGX.match(waitdata):
                     req.log_error("Invalid waitdata '" + waitdata + "' when adding " + user + " to queue. \n")
                     return apache.HTTP_BAD_REQUEST
-                addquser(user, waitdata, queue, room)
+                try:
+                    addquser(user, waitdata, queue, room)
+                except sqlite3.IntegrityError:
+                    req.log_error("User %s is already in queue %s in room %s\r\n" % (user, queue, room))
+                    return apache.HTTP_BAD_REQUEST
                 lockAndWriteLog(",".join([str(time()), user, "uadd", room, queue, waitdata]))
                 req.write("success\n")
             elif will_del:
@@ -749,7 +2636,7 @@ def handler(req):
                 lockAndWriteLog(",".join([str(time()), user, "usdel", room, queue, username]))
                 req.write("success\n")
             else:
-                req.log_error("Invalid action in querychecked: " + query.get('action', None) + "\n")
+                req.log_error("Invalid action in querychecked: " + action + "\n")
                 return apache.HTTP_BAD_REQUEST
         except sqlite3.IntegrityError: 
             req.log_error("IntegrityError: Error adding/removing station %d for user %s in room %s from %s\r\n" % (user, room, ip))
@@ -763,33 +2650,18 @@ def handler(req):
     # Otherwise it is waiting for updates
     #
     elif 'sseupdate' in query:
-        room = query.get('room', '').encode('ascii').strip()
-        if room == '' or "room"+room not in rooms:
+        room = getfield(query, 'room').strip()
+        if room == '' or room not in rooms:
             req.log_error("Room %s not found in database" % room)
             return apache.HTTP_BAD_REQUEST
         req.headers_out['Cache-Control'] = 'no-cache;public'
         req.content_type = "text/event-stream;charset=UTF-8"
         req.send_http_header()
-        req.write("data: %s\n\r" % json.dumps(getusers("", room)))
-        global wm
-        wm = pyinotify.WatchManager()
-        notifier = pyinotify.Notifier(wm, EventHandler(room), timeout=30*1000)
-        wm.add_watch(room_db, pyinotify.IN_MODIFY, rec=True)
-        # start pyinotify
-        while True:
-            notifier.process_events()
-            while notifier.check_events():
-                # above line returns after 30 seconds or if room is updated
-                notifier.read_events()
-                notifier.process_events()
-            try:
-                req.write("data: %s\n\r" % json.dumps(getusers("", room)))
-            except:
-                wm.close()
-                try:
-                    sys.exit(0)
-                except:
-                    os._exit(0)
+        # every subscriber to this room in this process shares one hub
+        hub = getroomhub(room, room_db)
+        deltas = getfield(query, 'delta') == '1'
+        streamhub(req, hub, until="{}", deltas=deltas, lastid=req.headers_in.get('Last-Event-ID', None))
+        return apache.OK
     else:
         req.content_type = "text/plain"
         req.send_http_header()
@@ -0,0 +1,92 @@
+#! /usr/bin/env python3
+# WSGI entry point for roomd.py, for serving QueUp from a long-running
+# application server (gunicorn, uWSGI, mod_wsgi, ...) instead of mod_python.
+# the process stays up between requests, so roomd's connection pool, caches,
+# hubs and rate limiter stay warm. e.g.:
+#
+#   QUEUP_PRIVATE=/path/to/private/queup/ gunicorn --threads 8 wsgi:application
+#
+# the server (or a proxy in front of it) must authenticate users and pass the
+# user on as REMOTE_USER, or in the header named by QUEUP_USER_HEADER.
+# sseupdate streams hold a worker for as long as they are open; in production
+# proxy them to eventd.py instead.
+import os
+import sys
+from http.client import responses
+from urllib.parse import parse_qs
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import roomd
+
+roomd.private = os.path.join(os.environ.get("QUEUP_PRIVATE", os.environ.get("HOME", "") + "/private/queup/"), "")
+USER_HEADER = os.environ.get("QUEUP_USER_HEADER", "")
+MAX_BODY = 65536
+
+class Headers:
+    # case-insensitive request headers, read like mod_python's req.headers_in
+    def __init__(self, environ):
+        self.environ = environ
+    def get(self, name, default=None):
+        return self.environ.get("HTTP_" + name.upper().replace("-", "_"), default)
+
+class Request:
+    # the parts of a mod_python request that roomd.dispatch uses
+    def __init__(self, environ, start_response):
+        self.environ = environ
+        self.start_response = start_response
+        if USER_HEADER != "":
+            self.user = Headers(environ).get(USER_HEADER, "")
+        else:
+            self.user = environ.get("REMOTE_USER", "")
+        self.useragent_ip = environ.get("REMOTE_ADDR", "")
+        self.headers_in = Headers(environ)
+        self.headers_out = {}
+        self.content_type = "text/plain"
+        self.out = []
+        self.stream = None
+    def query(self):
+        # like mod_python's FieldStorage, fields from the query string and a
+        # form body, with blank values dropped
+        fields = parse_qs(self.environ.get("QUERY_STRING", ""))
+        if self.environ.get("REQUEST_METHOD", "GET") == "POST" and \
+           self.environ.get("CONTENT_TYPE", "").startswith("application/x-www-form-urlencoded"):
+            try:
+                length = min(int(self.environ.get("CONTENT_LENGTH", "") or 0), MAX_BODY)
+            except ValueError:
+                length = 0
+            body = self.environ["wsgi.input"].read(length).decode("utf-8", "replace")
+            for name, values in parse_qs(body).items():
+                fields.setdefault(name, []).extend(values)
+        return dict([(name, values[0]) for name, values in fields.items()])
+    def headers(self):
+        return [("Content-Type", self.content_type)] + list(self.headers_out.items())
+    def send_http_header(self):
+        # event streams are written as they are produced; anything else is
+        # buffered until the handler returns its status
+        if self.content_type.startswith("text/event-stream"):
+            self.stream = self.start_response("200 OK", self.headers())
+    def write(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode("utf-8")
+        if self.stream is not None:
+            self.stream(data)
+        else:
+            self.out.append(data)
+    def log_error(self, message):
+        self.environ["wsgi.errors"].write(message.rstrip() + "\n")
+
+def application(environ, start_response):
+    req = Request(environ, start_response)
+    status = roomd.dispatch(req, req.query)
+    if req.stream is not None:
+        return []
+    if status == roomd.apache.OK:
+        status = 200
+    start_response("%d %s" % (status, responses.get(status, "")), req.headers())
+    return req.out
+
+if __name__ == "__main__":
+    # a single-threaded development server
+    from wsgiref.simple_server import make_server
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
+    make_server("127.0.0.1", port, application).serve_forever()